@@ -1,46 +1,411 @@
-from gevent import monkey
+from gevent import monkey, get_hub
 
 monkey.patch_all()
 
-from apiflask import APIFlask, Schema
-from apiflask.fields import String, Date
-from flask import send_file, send_from_directory
+from apiflask import APIFlask, Schema, abort
+from apiflask.fields import String, Date, Integer, List
+from apiflask.validators import OneOf
+from flask import Response, request, send_file
 from flask_compress import Compress
-from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from epg.generator import diyp as diyp_generator
+from epg.generator import guide as guide_generator
+from epg.generator import xmltv as xmltv_generator
+from epg.model import Channel, Program
+from datetime import date, datetime, timedelta, timezone
+from collections.abc import Callable
+from typing import Any
+import hashlib
+import json
+import mimetypes
 import os
+import time
+import traceback
 
 
 app = APIFlask(__name__, docs_path=None)
 Compress(app)
 
 
+CACHE_CONTROL = "public, max-age=300"  # epg.xml and index.html, also in config/epg.conf
+_etags: dict[str, tuple] = {}
+
+
+def file_etag(path: str) -> str:
+    """
+    Get the content hash of a file as its ETag, hashed again only when the file changes.
+    """
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _etags.get(path)
+    if cached is None or cached[0] != key:
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        if len(_etags) >= 65536:
+            _etags.clear()
+        cached = (key, sha.hexdigest())
+        _etags[path] = cached
+    return cached[1]
+
+
+def send_precompressed(path: str, cache_control: str = CACHE_CONTROL):
+    """
+    Send the precompressed path + ".gz" if the client accepts gzip and it exists, else send path.
+    Compress skips responses that already have a Content-Encoding.
+    Conditional and range requests are answered with 304 and 206.
+    """
+    gz_path = path + ".gz"
+    if "gzip" in request.accept_encodings and os.path.isfile(gz_path):
+        response = send_file(
+            gz_path,
+            mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream",
+            etag=file_etag(gz_path),
+        )
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = send_file(path, etag=file_etag(path))
+    response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+
+RELOAD_CHECK = 5  # seconds between checks for a new build output
+DIYP_CACHE_SIZE = int(os.getenv("DIYP_CACHE_SIZE", "256"))  # MB, 0 to disable
+ENTRY_OVERHEAD = 300  # bytes of dict, key and tuple per cached channel-day
+
+
+class Reloaded:
+    """
+    Data loaded from a build output, replaced as a whole when the build writes the file again.
+    The DIYP snapshot and the guide index are both reloaded through it.
+    get() checks the file at most every RELOAD_CHECK seconds, and loads a new one in the thread pool
+    of the gevent hub, so the blocking reads don't stall other requests. Requests keep using the old data
+    until the new one is swapped in. If loading fails, the error is printed and the old data is kept
+    until the file changes again.
+
+    Methods:
+        reload() -> None: Load the file now, in the calling thread, if it changed since the last load.
+        get() -> Any: Get the current data.
+    """
+
+    def __init__(self, path: str, load: Callable[[], Any], default: Any) -> None:
+        self.path = path
+        self.load = load
+        self.data = default
+        self.__version = None
+        self.__checked = float("-inf")
+        self.__loading = False
+
+    def __changed(self) -> tuple | None:
+        # The new version of the file, None if it is unchanged or missing
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        version = (stat.st_ino, stat.st_mtime_ns)
+        return version if version != self.__version else None
+
+    def reload(self) -> None:
+        version = self.__changed()
+        if version is None:
+            return
+        # Not retried before the file changes again, even if it fails
+        self.__version = version
+        try:
+            data = self.load()
+        except Exception:
+            print("failed to reload", self.path, "keep the old data", flush=True)
+            traceback.print_exc()
+            return
+        self.data = data
+
+    def __reload_in_background(self) -> None:
+        try:
+            self.reload()
+        finally:
+            self.__loading = False
+
+    def get(self) -> Any:
+        if time.monotonic() - self.__checked >= RELOAD_CHECK and not self.__loading:
+            self.__checked = time.monotonic()
+            if self.__changed() is not None:
+                self.__loading = True
+                get_hub().threadpool.spawn(self.__reload_in_background)
+        return self.data
+
+
+class DiypFile:
+    """
+    A DIYP file and its gzip, with their ETags.
+    """
+
+    __slots__ = ("content", "content_gz", "etag", "etag_gz", "last_modified")
+
+    def __init__(
+        self, content: bytes, content_gz: bytes | None, last_modified: datetime
+    ) -> None:
+        self.content = content
+        self.content_gz = content_gz
+        self.etag = hashlib.sha1(content).hexdigest()
+        self.etag_gz = (
+            None if content_gz is None else hashlib.sha1(content_gz).hexdigest()
+        )
+        self.last_modified = last_modified
+
+
+class DiypSnapshot:
+    """
+    DIYP files of one publish, held in memory.
+
+    Attributes:
+        aliases (dict[str, str]): The alias index.
+        files (dict[tuple[str, str], DiypFile]): The files by (DIYP name, date),
+            days closest to today first until the memory ceiling.
+    """
+
+    def __init__(self, aliases=None, files=None) -> None:
+        self.aliases = aliases or {}
+        self.files = files or {}
+
+
+def load_diyp_snapshot(dir: str) -> DiypSnapshot:
+    """
+    Load DIYP files of the published generation into a snapshot, within DIYP_CACHE_SIZE.
+    """
+    # Pin the generation, the symlink may be swapped while loading
+    real_dir = os.path.realpath(dir)
+    try:
+        with open(os.path.join(real_dir, diyp_generator.ALIASES), "rb") as f:
+            aliases = json.load(f)
+    except (OSError, ValueError):
+        aliases = {}
+    today = datetime.now().date()
+    entries = []
+    for name in os.listdir(real_dir):
+        if not os.path.isdir(os.path.join(real_dir, name)):
+            continue
+        for filename in os.listdir(os.path.join(real_dir, name)):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                day = date.fromisoformat(filename[:-5])
+            except ValueError:
+                continue
+            entries.append((abs((day - today).days), name, filename[:-5]))
+    entries.sort()
+    files = {}
+    budget = DIYP_CACHE_SIZE * 1024 * 1024
+    for _, name, day in entries:
+        path = os.path.join(real_dir, name, day + ".json")
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+                last_modified = datetime.fromtimestamp(
+                    os.fstat(f.fileno()).st_mtime, timezone.utc
+                )
+            with open(path + ".gz", "rb") as f:
+                content_gz = f.read()
+        except FileNotFoundError:
+            content_gz = None
+        except OSError:
+            continue
+        budget -= len(content) + len(content_gz or b"") + ENTRY_OVERHEAD
+        if budget < 0:
+            break
+        files[(name, day)] = DiypFile(content, content_gz, last_modified)
+    print(f"diyp cache: {len(files)}/{len(entries)} files of {real_dir}", flush=True)
+    return DiypSnapshot(aliases, files)
+
+
+diyp_snapshot = Reloaded(
+    diyp_generator.get_manifest_path(os.path.join(os.getcwd(), "web", "diyp_files")),
+    lambda: load_diyp_snapshot(os.path.join(os.getcwd(), "web", "diyp_files")),
+    DiypSnapshot(),
+)
+guide_index = Reloaded(
+    os.path.join(os.getcwd(), "web", "guide.json"),
+    lambda: guide_generator.load(os.path.join(os.getcwd(), "web", "guide.json")),
+    guide_generator.Guide(),
+)
+# Preload at startup
+diyp_snapshot.reload()
+guide_index.reload()
+
+
+def send_diyp(file: DiypFile, day: str):
+    if file.content_gz is not None and "gzip" in request.accept_encodings:
+        response = Response(file.content_gz, mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(file.etag_gz)
+    else:
+        response = Response(file.content, mimetype="application/json")
+        response.set_etag(file.etag)
+    response.last_modified = file.last_modified
+    response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = diyp_generator.cache_control(
+        day, datetime.now().date().isoformat()
+    )
+    return response.make_conditional(request)
+
+
 class ChannelIn(Schema):
     ch = String(required=True)
     date = Date("%Y-%m-%d", required=True)
 
 
 @app.route("/diyp")
+def diyp():
+    # Fast path, the query is looked up as is
+    snapshot = diyp_snapshot.get()
+    ch = request.args.get("ch")
+    if ch is not None:
+        name = diyp_generator.resolve(snapshot.aliases, ch)
+        day = request.args.get("date")
+        cached = snapshot.files.get((name, day))
+        if cached is not None:
+            return send_diyp(cached, day)
+    return diyp_file()
+
+
 @app.input(ChannelIn, "query")
-def diyp(query_data):
-    ch = query_data["ch"]
+def diyp_file(query_data):
+    ch = (
+        diyp_generator.resolve(diyp_snapshot.get().aliases, query_data["ch"])
+        or query_data["ch"]
+    )
     date = query_data["date"]
+    path = safe_join(
+        os.path.join(os.getcwd(), "web", "diyp_files"),
+        ch,
+        date.strftime("%Y-%m-%d") + ".json",
+    )
+    if path is None or not os.path.isfile(path):
+        return send_file(os.path.join(os.getcwd(), "web", "404.json"))
+    return send_precompressed(
+        path,
+        diyp_generator.cache_control(
+            date.strftime("%Y-%m-%d"), datetime.now().date().isoformat()
+        ),
+    )
+
+
+def program_json(program: tuple | None) -> dict | None:
+    if program is None:
+        return None
+    start, stop, title, sub_title, desc = program
+    return {
+        # astimezone() to the local time zone, the same as DIYP files
+        "start": datetime.fromtimestamp(start, timezone.utc).astimezone().isoformat(),
+        "end": datetime.fromtimestamp(stop, timezone.utc).astimezone().isoformat(),
+        "title": title,
+        "sub_title": sub_title,
+        "desc": desc,
+    }
+
+
+class NowIn(Schema):
+    ch = List(String(), load_default=[])
+    time = Integer()
+
+
+@app.route("/now")
+@app.input(NowIn, "query")
+def now_next(query_data):
+    """
+    The playing and the next program of all channels, or of the channels given by repeated ch.
+    """
+    guide = guide_index.get()
+    now = query_data.get("time", int(time.time()))
+    if query_data["ch"] == []:
+        channels = guide.channels
+    else:
+        channels = [guide.find(ch) for ch in query_data["ch"]]
+    result = []
+    for channel in channels:
+        if channel is None:
+            continue
+        playing, upcoming = channel.now_next(now)
+        result.append(
+            {
+                "id": channel.id,
+                "name": channel.name[0],
+                "now": program_json(playing),
+                "next": program_json(upcoming),
+            }
+        )
+    return {"time": now, "channels": result}
+
+
+def parse_time(value: str, end: bool = False) -> int:
+    """
+    Parse a unix timestamp, or a local date. An end date includes the whole day.
+    """
+    if value.isascii() and value.isdigit():
+        return int(value)
     try:
-        return send_from_directory(
-            directory=os.path.join(os.getcwd(), "web", "diyp_files"),
-            path=os.path.join(ch, date.strftime("%Y-%m-%d") + ".json"),
+        day = date.fromisoformat(value)
+    except ValueError:
+        abort(422, f"Not a valid date or timestamp: {value}")
+    if end:
+        day += timedelta(1)
+    return int(datetime(day.year, day.month, day.day).astimezone().timestamp())
+
+
+class RangeIn(Schema):
+    ch = String(required=True)
+    start = String(required=True)
+    end = String(required=True)
+    format = String(load_default="json", validate=OneOf(["json", "xmltv"]))
+
+
+@app.route("/range")
+@app.input(RangeIn, "query")
+def program_range(query_data):
+    """
+    The programs of a channel from start to end, as dates (YYYY-MM-DD, both included) or unix timestamps.
+    """
+    channel = guide_index.get().find(query_data["ch"])
+    if channel is None:
+        abort(404, f"Unknown channel: {query_data['ch']}")
+    start = parse_time(query_data["start"])
+    end = parse_time(query_data["end"], end=True)
+    programs = channel.between(start, end)
+    if query_data["format"] == "xmltv":
+        xmltv_channel = Channel(channel.id, {"name": channel.name})
+        xmltv_channel.programs = [
+            Program(
+                title,
+                datetime.fromtimestamp(program_start, timezone.utc),
+                datetime.fromtimestamp(program_stop, timezone.utc),
+                channel.id,
+                desc,
+                sub_title=sub_title,
+            )
+            for program_start, program_stop, title, sub_title, desc in programs
+        ]
+        return Response(
+            xmltv_generator.fragment([xmltv_channel], "epghub"),
+            mimetype="application/xml",
         )
-    except (FileNotFoundError, NotFound):
-        return send_file(os.path.join(os.getcwd(), "web", "404.json"))
+    return {
+        "id": channel.id,
+        "name": channel.name[0],
+        "start": start,
+        "end": end,
+        "programs": [program_json(program) for program in programs],
+    }
 
 
 @app.route("/")
 def index():
-    return send_file(os.path.join(os.getcwd(), "web", "index.html"))
+    return send_precompressed(os.path.join(os.getcwd(), "web", "index.html"))
 
 
 @app.route("/epg.xml")
 def epg_xml():
-    return send_file(os.path.join(os.getcwd(), "web", "epg.xml"))
+    return send_precompressed(os.path.join(os.getcwd(), "web", "epg.xml"))
 
 
 @app.route("/robots.txt")
@@ -17,53 +17,282 @@
 #         }
 #     ]
 # }
+#
+# Files are published incrementally. With atomic=True (default):
+#   dir              -> symlink to .dir/<generation>
+#   .dir/<generation>/<channel_name>/<date>.json
+#   .dir/manifest.json   the generation and hash of every published file
+# Unchanged files are hard linked from the previous generation, then the symlink is swapped,
+# so readers never see a half-built tree.
+# With gzip=True, every <date>.json has a precompressed <date>.json.gz sibling.
+# aliases.json maps every configured name, and its normalized form, to the <channel_name> directory,
+# so other names resolve without duplicating files.
 
 from epg.model import Channel
+from datetime import datetime
+import gzip as gz
+import hashlib
 import json
 import os
+import re
 import shutil
+import unicodedata
 
+ALIASES = "aliases.json"
+# Cache-Control of a DIYP day, also in config/epg.conf
+CACHE_CONTROL_PAST = "public, max-age=604800, immutable"
+CACHE_CONTROL_TODAY = "public, max-age=300"
+CACHE_CONTROL_FUTURE = "public, max-age=3600"
 
-def write(dir: str, channels: list[Channel]) -> bool:
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-    else:
-        shutil.rmtree(dir)
-        os.makedirs(dir)
+
+def payloads(channels: list[Channel]) -> dict[str, bytes]:
+    """
+    Build the DIYP json of every channel-day.
+
+    Returns:
+        dict[str, bytes]: The json by relative path "<channel_name>/<date>.json".
+    """
+    files = {}
     for channel in channels:
-        channel_epg = {}
-        for program in channel.programs:
+        for day, programs in channel.programs.days().items():
+            channel_epg = {
+                "channel_name": channel.metadata["name"][0],
+                "date": day.strftime("%Y-%m-%d"),
+                "epg_data": [
+                    {
+                        "start": program.start_time.astimezone().strftime(
+                            "%H:%M"
+                        ),  # astimezone() is necessary
+                        "end": program.end_time.astimezone().strftime(
+                            "%H:%M"
+                        ),  # astimezone() is necessary
+                        "title": program.title,
+                        "desc": program.desc,
+                    }
+                    for program in programs
+                ],
+            }
+            files[
+                os.path.join(channel_epg["channel_name"], channel_epg["date"] + ".json")
+            ] = json.dumps(
+                channel_epg, ensure_ascii=False, separators=(",", ":")
+            ).encode()
+    return files
+
+
+def normalize_name(name: str) -> str:
+    """
+    Normalize a channel name for lookups: full-width to half-width, case folded,
+    without spaces, dashes and underscores. "ＣＣＴＶ-1" and "cctv 1" both become "cctv1".
+    """
+    return re.sub(r"[\s\-_]+", "", unicodedata.normalize("NFKC", name).casefold())
+
+
+def aliases(channels: list[Channel]) -> dict[str, str]:
+    """
+    Build the alias index of channels. The first name of a channel is its DIYP name.
+    Exact names win over normalized ones, and earlier channels win over later ones.
+
+    Returns:
+        dict[str, str]: The DIYP name by every configured name and normalized form.
+    """
+    index = {}
+    keys = [
+        # DIYP names first, then the other names, then normalized forms
+        [(channel.metadata["name"][0], channel) for channel in channels],
+        [(name, channel) for channel in channels for name in channel.metadata["name"]],
+        [
+            (normalize_name(name), channel)
+            for channel in channels
+            for name in channel.metadata["name"]
+        ],
+    ]
+    for key, channel in (item for items in keys for item in items):
+        diyp_name = channel.metadata["name"][0]
+        if index.setdefault(key, diyp_name) != diyp_name:
+            print(f"diyp alias {key} of {channel.id} is taken by {index[key]}")
+    return index
+
+
+def resolve(index: dict[str, str], name: str) -> str | None:
+    """
+    Resolve a requested channel name to its DIYP name, or None if unknown.
+    """
+    return index.get(name) or index.get(normalize_name(name))
+
+
+def cache_control(day: str, today: str) -> str:
+    """
+    Get the Cache-Control of a DIYP day. Past days hardly change, today is refreshed most.
+
+    Args:
+        day (str): The date of the file, YYYY-MM-DD.
+        today (str): Today, YYYY-MM-DD.
+
+    Returns:
+        str: The Cache-Control header value.
+    """
+    if day < today:
+        return CACHE_CONTROL_PAST
+    if day == today:
+        return CACHE_CONTROL_TODAY
+    return CACHE_CONTROL_FUTURE
+
+
+def get_manifest_path(dir: str) -> str:
+    """
+    Get the manifest path of a DIYP directory. It is written last, so it changes once per publish.
+    """
+    return os.path.join(
+        os.path.dirname(dir), "." + os.path.basename(dir), "manifest.json"
+    )
+
+
+def write(
+    dir: str, channels: list[Channel], atomic: bool = True, gzip: bool = True
+) -> bool:
+    """
+    Write DIYP json files, only the ones whose content changed.
+
+    Args:
+        dir (str): The directory to publish.
+        channels (list[Channel]): The channels to write.
+        atomic (bool, optional): Publish a new generation by swapping a symlink.
+            Otherwise update files in place, each one atomically. Defaults to True.
+        gzip (bool, optional): Write precompressed .gz siblings. Defaults to True.
+
+    Returns:
+        bool: True if written.
+    """
+    manifest_path = get_manifest_path(dir)
+    state_dir = os.path.dirname(manifest_path)
+    os.makedirs(state_dir, exist_ok=True)
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {"generation": None, "files": {}}
+    files = payloads(channels)
+    files[ALIASES] = json.dumps(
+        aliases(channels), ensure_ascii=False, separators=(",", ":")
+    ).encode()
+    hashes = {
+        path: hashlib.sha1(content).hexdigest() for path, content in files.items()
+    }
+    suffixes = ["", ".gz"] if gzip else [""]
+    if atomic:
+        generation = _write_generation(
+            dir, state_dir, manifest, files, hashes, suffixes
+        )
+    else:
+        generation = _write_in_place(dir, manifest, files, hashes, suffixes)
+    _write_file(
+        manifest_path, json.dumps({"generation": generation, "files": hashes}).encode()
+    )
+    num_changed = sum(
+        1 for path in hashes if manifest["files"].get(path) != hashes[path]
+    )
+    num_stale = len(manifest["files"].keys() - hashes.keys())
+    print(
+        f"diyp files: {len(files)}, changed: {num_changed}, stale: {num_stale}",
+        flush=True,
+    )
+    return True
+
+
+def _variants(content: bytes, suffixes: list[str]):
+    """
+    Generate (suffix, content) of a file and its compressed siblings.
+    """
+    for suffix in suffixes:
+        if suffix == ".gz":
+            # mtime=0 to get the same bytes for the same content
+            yield (suffix, gz.compress(content, mtime=0))
+        else:
+            yield (suffix, content)
+
+
+def _write_file(path: str, content: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _write_generation(
+    dir: str,
+    state_dir: str,
+    manifest: dict,
+    files: dict,
+    hashes: dict,
+    suffixes: list[str],
+) -> str:
+    generation = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    generation_dir = os.path.join(state_dir, generation)
+    current_dir = (
+        os.path.join(state_dir, manifest["generation"])
+        if manifest["generation"] is not None and os.path.islink(dir)
+        else None
+    )
+    for path, content in files.items():
+        target = os.path.join(generation_dir, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if current_dir is not None and manifest["files"].get(path) == hashes[path]:
             try:
-                channel_epg[program.start_time.strftime("%Y-%m-%d")]["channel_name"]
-            except KeyError:
-                channel_epg[program.start_time.strftime("%Y-%m-%d")] = {}
-            channel_epg[program.start_time.strftime("%Y-%m-%d")][
-                "channel_name"
-            ] = channel.metadata["name"][0]
-            channel_epg[program.start_time.strftime("%Y-%m-%d")][
-                "date"
-            ] = program.start_time.strftime("%Y-%m-%d")
+                for suffix in suffixes:
+                    os.link(os.path.join(current_dir, path + suffix), target + suffix)
+                continue
+            except OSError:
+                # Not linked as a whole, write again
+                for suffix in suffixes:
+                    if os.path.lexists(target + suffix):
+                        os.remove(target + suffix)
+        for suffix, variant in _variants(content, suffixes):
+            with open(target + suffix, "wb") as f:
+                f.write(variant)
+    # Swap the symlink atomically
+    tmp_link = dir + ".tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.join(os.path.basename(state_dir), generation), tmp_link)
+    if os.path.isdir(dir) and not os.path.islink(dir):
+        # Directory of a previous version, can't be swapped atomically
+        legacy_dir = os.path.join(state_dir, "legacy")
+        shutil.rmtree(legacy_dir, ignore_errors=True)
+        os.rename(dir, legacy_dir)
+    os.replace(tmp_link, dir)
+    # Keep the previous generation for readers still on it
+    for name in os.listdir(state_dir):
+        if name in (generation, manifest["generation"], "manifest.json"):
+            continue
+        shutil.rmtree(os.path.join(state_dir, name), ignore_errors=True)
+    return generation
+
+
+def _write_in_place(
+    dir: str, manifest: dict, files: dict, hashes: dict, suffixes: list[str]
+) -> None:
+    if os.path.islink(dir):
+        # Published as generations before
+        os.remove(dir)
+        manifest["files"] = {}
+    for path, content in files.items():
+        target = os.path.join(dir, path)
+        if manifest["files"].get(path) == hashes[path] and all(
+            os.path.exists(target + suffix) for suffix in suffixes
+        ):
+            continue
+        for suffix, variant in _variants(content, suffixes):
+            _write_file(target + suffix, variant)
+    for path in manifest["files"].keys() - files.keys():
+        for suffix in ("", ".gz"):
             try:
-                channel_epg[program.start_time.strftime("%Y-%m-%d")]["epg_data"]
-            except KeyError:
-                channel_epg[program.start_time.strftime("%Y-%m-%d")]["epg_data"] = []
-            channel_epg[program.start_time.strftime("%Y-%m-%d")]["epg_data"].append(
-                {
-                    "start": program.start_time.astimezone().strftime(
-                        "%H:%M"
-                    ),  # astimezone() is necessary
-                    "end": program.end_time.astimezone().strftime(
-                        "%H:%M"
-                    ),  # astimezone() is necessary
-                    "title": program.title,
-                    "desc": program.desc,
-                }
-            )
-        for date in channel_epg:
-            json_dir = os.path.join(dir, channel_epg[date]["channel_name"])
-            if not os.path.exists(json_dir):
-                os.makedirs(json_dir)
-            json_path = os.path.join(json_dir, channel_epg[date]["date"] + ".json")
-            with open(json_path, "w") as f:
-                json.dump(channel_epg[date], f, ensure_ascii=False, indent=4)
-    return True
+                os.remove(os.path.join(dir, path + suffix))
+            except OSError:
+                pass
+        try:
+            os.rmdir(os.path.dirname(os.path.join(dir, path)))
+        except OSError:
+            pass
+    return None
@@ -0,0 +1,153 @@
+# Example:
+# {
+#     "channels": [
+#         {
+#             "id": "cctv1",
+#             "name": ["CCTV1"],
+#             "programs": [
+#                 [1696867200, 1696870740, "title", "sub title", "desc"],
+#                 ...
+#             ]
+#         }
+#     ]
+# }
+#
+# The guide index of the API. Programs are sorted by start, times are unix timestamps,
+# so the API finds programs at a time or in a range by bisecting.
+
+from epg.model import Channel
+from epg.generator.diyp import normalize_name
+from bisect import bisect_left, bisect_right
+import json
+import os
+
+
+def write(filepath: str, channels: list[Channel]) -> bool:
+    """
+    Write the guide index of channels, atomically.
+
+    Args:
+        filepath (str): The index file path.
+        channels (list[Channel]): The channels to write.
+
+    Returns:
+        bool: True if written.
+    """
+    guide = {
+        "channels": [
+            {
+                "id": channel.id,
+                "name": channel.metadata["name"],
+                "programs": [
+                    [
+                        int(program.start_time.timestamp()),
+                        int(program.end_time.timestamp()),
+                        program.title,
+                        program.sub_title,
+                        program.desc,
+                    ]
+                    for program in channel.programs
+                ],
+            }
+            for channel in channels
+        ]
+    }
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(guide, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, filepath)
+    return True
+
+
+class ChannelGuide:
+    """
+    Programs of a channel, sorted by start, for lookups by time.
+
+    Attributes:
+        id (str): The channel id.
+        name (list[str]): The channel names.
+        programs (list[tuple]): The programs as (start, stop, title, sub_title, desc).
+
+    Methods:
+        now_next(now: int) -> tuple: Get the playing and the next program.
+        between(start: int, end: int) -> list[tuple]: Get programs overlapping start to end.
+    """
+
+    __slots__ = ("id", "name", "programs", "starts")
+
+    def __init__(self, id: str, name: list[str], programs: list[tuple]) -> None:
+        self.id = id
+        self.name = name
+        self.programs = programs
+        self.starts = [program[0] for program in programs]
+
+    def now_next(self, now: int) -> tuple[tuple | None, tuple | None]:
+        """
+        Get the program playing at now and the next one, None if there is no such program.
+        """
+        index = bisect_right(self.starts, now)
+        playing = None
+        if index > 0 and now < self.programs[index - 1][1]:
+            playing = self.programs[index - 1]
+        upcoming = self.programs[index] if index < len(self.programs) else None
+        return (playing, upcoming)
+
+    def between(self, start: int, end: int) -> list[tuple]:
+        """
+        Get the programs playing at any time from start to end, end excluded.
+        """
+        first = bisect_right(self.starts, start)
+        if first > 0 and start < self.programs[first - 1][1]:
+            first -= 1
+        return self.programs[first : bisect_left(self.starts, end)]
+
+
+class Guide:
+    """
+    Guide of all channels.
+
+    Attributes:
+        channels (list[ChannelGuide]): The channels in the written order.
+
+    Methods:
+        find(name: str) -> ChannelGuide | None: Find a channel by id, name or normalized name.
+    """
+
+    def __init__(self, channels: list[ChannelGuide] | None = None) -> None:
+        self.channels = channels or []
+        self.__lookup = {}
+        for channel in self.channels:
+            self.__lookup.setdefault(channel.id, channel)
+        for channel in self.channels:
+            for name in channel.name:
+                self.__lookup.setdefault(name, channel)
+        for channel in self.channels:
+            for name in channel.name:
+                self.__lookup.setdefault(normalize_name(name), channel)
+
+    def find(self, name: str) -> ChannelGuide | None:
+        return self.__lookup.get(name) or self.__lookup.get(normalize_name(name))
+
+
+def load(filepath: str) -> Guide:
+    """
+    Load a guide index written by write().
+
+    Args:
+        filepath (str): The index file path.
+
+    Returns:
+        Guide: The guide of all channels.
+    """
+    with open(filepath, "r", encoding="utf-8") as f:
+        guide = json.load(f)
+    return Guide(
+        [
+            ChannelGuide(
+                channel["id"],
+                channel["name"],
+                [tuple(program) for program in channel["programs"]],
+            )
+            for channel in guide["channels"]
+        ]
+    )
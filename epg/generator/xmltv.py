@@ -1,51 +1,194 @@
 # https://github.com/XMLTV/xmltv/blob/master/xmltv.dtd
 
 from lxml import etree
+from epg import profiler
 from epg.model import Channel
 from datetime import datetime
+import gzip
+import os
 
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+DOCTYPE = '<!DOCTYPE tv SYSTEM "xmltv.dtd">'
 
-def write(filepath: str, channels: list[Channel], info: str = "") -> bool:
-    root = etree.Element("tv")
-    tree = etree.ElementTree(root)
-    tree.docinfo.system_url = "xmltv.dtd"
-    root.set("generator-info-name", info)
-    last_update_time_list = []
+
+class _Tee:
+    """
+    Write to several files at once.
+    """
+
+    def __init__(self, *files) -> None:
+        self.files = files
+
+    def write(self, data: bytes) -> int:
+        for file in self.files:
+            file.write(data)
+        return len(data)
+
+
+class _Validator:
+    """
+    Validate elements against a DTD as they are written.
+    Channels are always validated, programmes one in every `sample`, none if `sample` is 0.
+    Only the first error is printed.
+    """
+
+    def __init__(self, dtd: etree.DTD | None, sample: int = 1) -> None:
+        self.dtd = dtd if sample > 0 else None
+        self.sample = sample
+        self.valid = True
+        self.__count = 0
+
+    def __call__(self, element: etree._Element) -> None:
+        if self.dtd is None or not self.valid:
+            return
+        if element.tag == "programme":
+            self.__count += 1
+            if (self.__count - 1) % self.sample != 0:
+                return
+        with profiler.measure("stages", "xmltv validation"):
+            valid = self.dtd.validate(element)
+        if not valid:
+            self.valid = False
+            print(
+                "invalid",
+                element.tag,
+                dict(element.attrib),
+                self.dtd.error_log.filter_from_errors()[0],
+            )
+
+
+def write(
+    filepath: str,
+    channels: list[Channel],
+    info: str = "",
+    gzip_path: str = "",
+    dtd: etree.DTD | None = None,
+    sample: int = 1,
+) -> bool:
+    """
+    Write channels to an XMLTV file, element by element without building the whole tree.
+    The output is the same as a pretty printed tree.
+    Both files are written next to their path and moved into place once complete, the gzip copy first,
+    so a server never sends a half-written file.
+    With a DTD, elements are validated as they are written, so the file needs no re-parsing.
+
+    Args:
+        filepath (str): The XMLTV file path.
+        channels (list[Channel]): The channels to write.
+        info (str, optional): The generator info name.
+        gzip_path (str, optional): Also write a gzip compressed copy to this path, in the same pass.
+        dtd (etree.DTD, optional): Validate the output with this DTD.
+        sample (int, optional): Validate one in every `sample` programmes. 0 means no validation. Defaults to 1.
+
+    Returns:
+        bool: True if written and valid.
+    """
+    last_update_time = max(channel.metadata["last_update"] for channel in channels)
+    date = datetime(
+        last_update_time.year,
+        last_update_time.month,
+        last_update_time.day,
+        tzinfo=last_update_time.tzinfo,
+    ).strftime("%Y%m%d%H%M%S %z")
+    validate = _Validator(dtd, sample)
+    tv_attrib = {"generator-info-name": info, "date": date}
+    validate(etree.Element("tv", tv_attrib))
+    with open(filepath + ".tmp", "wb") as f:
+        if gzip_path != "":
+            gz_file = open(gzip_path + ".tmp", "wb")
+            # The header names the final file, mtime=0 to get the same bytes for the same guide
+            gz = gzip.GzipFile(gzip_path, "wb", fileobj=gz_file, mtime=0)
+            output = _Tee(f, gz)
+        else:
+            gz = None
+            output = f
+        try:
+            output.write(XML_DECLARATION)
+            with etree.xmlfile(output, encoding="utf-8") as xf:
+                xf.write_doctype(DOCTYPE)
+                with xf.element("tv", tv_attrib):
+                    for channel in channels:
+                        element = channel_element(channel)
+                        validate(element)
+                        xf.write("\n  ")
+                        xf.write(element)
+                    for channel in channels:
+                        for element in programme_elements(channel):
+                            validate(element)
+                            xf.write("\n  ")
+                            xf.write(element)
+                    xf.write("\n")
+            output.write(b"\n")
+        finally:
+            if gz is not None:
+                gz.close()
+                gz_file.close()
+    if gzip_path != "":
+        os.replace(gzip_path + ".tmp", gzip_path)
+    os.replace(filepath + ".tmp", filepath)
+    return validate.valid
+
+
+def fragment(channels: list[Channel], info: str = "") -> bytes:
+    """
+    Serialize channels to a small XMLTV document in memory, for API responses.
+
+    Args:
+        channels (list[Channel]): The channels to serialize.
+        info (str, optional): The generator info name.
+
+    Returns:
+        bytes: The XMLTV document.
+    """
+    tv = etree.Element("tv", {"generator-info-name": info})
     for channel in channels:
-        last_update_time_list.append(channel.metadata["last_update"])
-        channel_element = etree.SubElement(root, "channel")
-        channel_element.set("id", channel.id)
-        for name in channel.metadata["name"]:
-            display_name = etree.SubElement(channel_element, "display-name")
-            display_name.text = name
-    last_update_time = max(last_update_time_list)
-    root.set(
-        "date",
-        datetime(
-            last_update_time.year,
-            last_update_time.month,
-            last_update_time.day,
-            tzinfo=last_update_time.tzinfo,
-        ).strftime("%Y%m%d%H%M%S %z"),
-    )
+        tv.append(channel_element(channel))
     for channel in channels:
-        channel.programs.sort(key=lambda x: x.start_time)
-        for program in channel.programs:
-            program_element = etree.SubElement(root, "programme")
-            program_element.set(
-                "start", program.start_time.astimezone().strftime("%Y%m%d%H%M%S %z")
-            )  # astimezone() is necessary
-            program_element.set(
-                "stop", program.end_time.astimezone().strftime("%Y%m%d%H%M%S %z")
-            )  # astimezone() is necessary
-            program_element.set("channel", channel.id)
-            title = etree.SubElement(program_element, "title")
-            title.text = program.title
-            if program.sub_title != "":
-                sub_title = etree.SubElement(program_element, "sub-title")
-                sub_title.text = program.sub_title
-            if program.desc != "":
-                desc = etree.SubElement(program_element, "desc")
-                desc.text = program.desc
-    tree.write(filepath, pretty_print=True, xml_declaration=True, encoding="utf-8")
-    return True
+        tv.extend(programme_elements(channel))
+    for element in tv:
+        element.tail = "\n  "
+    if len(tv) > 0:
+        tv.text = "\n  "
+        tv[-1].tail = "\n"
+    return XML_DECLARATION + etree.tostring(tv, encoding="utf-8", doctype=DOCTYPE)
+
+
+def channel_element(channel: Channel) -> etree._Element:
+    channel_element = etree.Element("channel")
+    channel_element.set("id", channel.id)
+    for name in channel.metadata["name"]:
+        display_name = etree.SubElement(channel_element, "display-name")
+        display_name.text = name
+    etree.indent(channel_element, level=1)
+    return channel_element
+
+
+def programme_elements(channel: Channel):
+    """
+    Generate programme elements of channel.
+    A program usually starts when the previous one ends, so the formatted time is reused.
+    """
+    last_time = None
+    last_time_str = ""
+    for program in channel.programs:
+        if program.start_time == last_time:
+            start_str = last_time_str
+        else:
+            # astimezone() is necessary
+            start_str = program.start_time.astimezone().strftime("%Y%m%d%H%M%S %z")
+        last_time = program.end_time
+        last_time_str = program.end_time.astimezone().strftime("%Y%m%d%H%M%S %z")
+        program_element = etree.Element("programme")
+        program_element.set("start", start_str)
+        program_element.set("stop", last_time_str)
+        program_element.set("channel", channel.id)
+        title = etree.SubElement(program_element, "title")
+        title.text = program.title
+        if program.sub_title != "":
+            sub_title = etree.SubElement(program_element, "sub-title")
+            sub_title.text = program.sub_title
+        if program.desc != "":
+            desc = etree.SubElement(program_element, "desc")
+            desc.text = program.desc
+        etree.indent(program_element, level=1)
+        yield program_element
@@ -3,15 +3,22 @@ This defines Program and Channel model.
 Basic proterties and functions.
 """
 
+import sys
+from bisect import bisect_right
 from datetime import datetime, date, timedelta
 from collections.abc import Callable
 from typing import Any
 from epg.scraper import tz_shanghai
 
 
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
 class Program:
     """
     Program model.
+    Slotted, with interned titles and channels, as guides hold many programs with repeated titles.
 
     Attributes:
         title (str): The program title.
@@ -22,6 +29,16 @@ class Program:
         episode (str): The program episode.
     """
 
+    __slots__ = (
+        "title",
+        "sub_title",
+        "start_time",
+        "end_time",
+        "desc",
+        "episode",
+        "channel",
+    )
+
     def __init__(
         self,
         title: str,
@@ -32,13 +49,13 @@ class Program:
         episode: str = "",
         sub_title: str = "",
     ) -> None:
-        self.title = title
-        self.sub_title = sub_title
+        self.title = _intern(title)
+        self.sub_title = _intern(sub_title)
         self.start_time = start_time
         self.end_time = end_time
         self.desc = desc
         self.episode = episode
-        self.channel = channel_id
+        self.channel = _intern(channel_id)
 
     def __eq__(self, other) -> bool:
         if isinstance(other, Program):
@@ -58,6 +75,94 @@ class Program:
         )
 
 
+class Programs:
+    """
+    Programs of a channel, partitioned by start date and sorted by start time.
+    Behaves like a list of programs for scrapers and plugins: append(), extend(), iteration, len() and indexing.
+    Programs must not change their start time once added.
+
+    Methods:
+        flush(date: date) -> None: Remove all programs of date.
+        days() -> dict[date, list[Program]]: Get programs by date, sorted by date.
+        find(now: datetime) -> int: Get the index of the first program starting after now.
+    """
+
+    __hash__ = None
+
+    def __init__(self, programs=()) -> None:
+        self.__days: dict[date, list[Program]] = {}
+        self.__flat: list[Program] | None = []
+        self.__starts: list[float] | None = None
+        self.extend(programs)
+
+    def append(self, program: Program) -> None:
+        day = self.__days.setdefault(program.start_time.date(), [])
+        if day == [] or day[-1].start_time <= program.start_time:
+            day.append(program)
+        else:
+            day.insert(
+                bisect_right(day, program.start_time, key=lambda x: x.start_time),
+                program,
+            )
+        self.__flat = None
+        self.__starts = None
+
+    def extend(self, programs) -> None:
+        for program in programs:
+            self.append(program)
+
+    def flush(self, date: date) -> None:
+        if self.__days.pop(date, None) is not None:
+            self.__flat = None
+            self.__starts = None
+
+    def sort(self, key=None, reverse: bool = False) -> None:
+        """
+        Programs are always sorted by start time, kept for list compatibility.
+        """
+        return None
+
+    def days(self) -> dict[date, list[Program]]:
+        """
+        Get programs by date, sorted by date. The lists are the index itself, don't modify them.
+        """
+        return {day: self.__days[day] for day in sorted(self.__days)}
+
+    def find(self, now: datetime) -> int:
+        if self.__starts is None:
+            self.__starts = [
+                program.start_time.timestamp() for program in self.__list()
+            ]
+        return bisect_right(self.__starts, now.timestamp())
+
+    def __list(self) -> list[Program]:
+        if self.__flat is None:
+            flat = []
+            for day in sorted(self.__days):
+                flat += self.__days[day]
+            # Almost sorted already, unless programs are in different time zones
+            flat.sort(key=lambda x: x.start_time)
+            self.__flat = flat
+        return self.__flat
+
+    def __iter__(self):
+        return iter(self.__list())
+
+    def __len__(self) -> int:
+        return sum(len(day) for day in self.__days.values())
+
+    def __getitem__(self, index):
+        return self.__list()[index]
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (list, Programs)):
+            return self.__list() == list(other)
+        return False
+
+    def __repr__(self) -> str:
+        return f"Programs({len(self)} programs in {len(self.__days)} days)"
+
+
 class Channel:
     """
     Channel model.
@@ -65,12 +170,13 @@ class Channel:
     Attributes:
         id (str): The channel id.
         metadata (dict): The channel metadata.
-        programs (list[Program]): The programs of the channel.
+        programs (Programs): The programs of the channel. Assigning a list of programs is accepted.
 
     Methods:
-        update(date: date = datetime.today().date()) -> bool: Update channel with new data for the given date.
-        now_playing(now: datetime = datetime.now()) -> Program | None: Get the program that is currently playing.
-        next_program(now: datetime = datetime.now()) -> Program | None: Get the next program.
+        update(date: date | None = None) -> bool: Update channel with new data for the given date, today by default.
+        update_range(start: date, end: date) -> dict[date, str]: Update channel with new data for a date range.
+        now_playing(now: datetime | None = None) -> Program | None: Get the program that is currently playing.
+        next_program(now: datetime | None = None) -> Program | None: Get the next program.
     """
 
     def __init__(
@@ -78,6 +184,7 @@ class Channel:
         id: str,
         metadata: dict = {},
         update_callable: Callable[[Any, date], bool] | None = None,
+        update_range_callable: Callable[[Any, date, date], dict] | None = None,
     ) -> None:
         self.__id = id
         self.metadata = metadata
@@ -85,6 +192,7 @@ class Channel:
             {"last_update": datetime(1970, 1, 1, 0, 0, 0, tzinfo=tz_shanghai)}
         )
         self.__update_callable = update_callable
+        self.__update_range_callable = update_range_callable
         self.programs = []
 
     def __eq__(self, other) -> bool:
@@ -101,11 +209,19 @@ class Channel:
     def id(self) -> str:
         return self.__id
 
+    @property
+    def programs(self) -> Programs:
+        return self.__programs
+
+    @programs.setter
+    def programs(self, value) -> None:
+        self.__programs = value if isinstance(value, Programs) else Programs(value)
+
     @id.setter
     def id(self, value: str) -> None:
         raise AttributeError("Cannot set attribute 'id'")
 
-    def update(self, date: date = datetime.today().date()) -> bool | tuple:
+    def update(self, date: date | None = None) -> bool | tuple:
         """
         Update channel with new data for the given date.
 
@@ -115,12 +231,35 @@ class Channel:
         Returns:
             bool: True if the update was successful, False otherwise.
         """
+        date = datetime.today().date() if date is None else date
         if self.__update_callable is not None:
             update_result = self.__update_callable(self, date)
             return update_result
         return False
 
-    def now_playing(self, now: datetime = datetime.now()) -> Program | None:
+    def update_range(self, start: date, end: date) -> dict[date, str]:
+        """
+        Update channel with new data for every date from start to end, both included.
+        Fall back to update() day by day if there is no range callable.
+
+        Args:
+            start (date): The first date to update.
+            end (date): The last date to update.
+
+        Returns:
+            dict[date, str]: The updated dates and the scraper used for each of them.
+        """
+        if self.__update_range_callable is not None:
+            return self.__update_range_callable(self, start, end)
+        updated = {}
+        dt = start
+        while dt <= end:
+            if self.update(dt):
+                updated[dt] = self.metadata.get("last_scraper", "")
+            dt += timedelta(1)
+        return updated
+
+    def now_playing(self, now: datetime | None = None) -> Program | None:
         """
         Get the program that is currently playing.
 
@@ -130,16 +269,15 @@ class Channel:
         Returns:
             Program: The program that is currently playing, or None if no program is playing.
         """
-        for program in self.programs:
-            if (
-                program.start_time.astimezone()
-                <= now.astimezone()
-                <= program.end_time.astimezone()
-            ):
+        now = datetime.now() if now is None else now
+        index = self.programs.find(now) - 1
+        if index >= 0:
+            program = self.programs[index]
+            if program.end_time is not None and now.astimezone() <= program.end_time:
                 return program
         return None
 
-    def next_program(self, now: datetime = datetime.now()) -> Program | None:
+    def next_program(self, now: datetime | None = None) -> Program | None:
         """
         Get the next program.
 
@@ -149,17 +287,38 @@ class Channel:
         Returns:
             Program: The next program, or None if there is no next program.
         """
-        self.programs.sort(key=lambda x: x.start_time)
-        for program in self.programs:
-            if program.start_time.astimezone() > now.astimezone():
-                return program
+        now = datetime.now() if now is None else now
+        index = self.programs.find(now)
+        if index < len(self.programs):
+            return self.programs[index]
         return None
 
     def flush(self, date) -> None:
         """
         Flush all programs of date
         """
-        self.programs = [
-            program for program in self.programs if program.start_time.date() != date
-        ]
+        self.programs.flush(date)
+        return None
+
+    def fork(self) -> "Channel":
+        """
+        Create an empty channel with the same id, a copy of metadata and the same update callable.
+        Scrap into the fork in a worker thread, then merge it back.
+        """
+        return Channel(
+            self.__id,
+            dict(self.metadata),
+            self.__update_callable,
+            self.__update_range_callable,
+        )
+
+    def merge(self, other: "Channel", dates: list[date]) -> None:
+        """
+        Replace programs of dates with the programs of a forked channel.
+        """
+        for dt in dates:
+            self.flush(dt)
+        self.programs.extend(other.programs)
+        self.metadata["last_scraper"] = other.metadata.get("last_scraper")
+        self.metadata["last_update"] = other.metadata["last_update"]
         return None
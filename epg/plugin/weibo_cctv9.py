@@ -4,8 +4,8 @@ from .__weibo_search import headers
 from datetime import date, datetime, timedelta
 from epg.model import Channel, Program
 import re
-import requests
 import json
+from epg.scraper import __http as http
 
 keyword = "#每日央视纪录片精选#"
 
@@ -53,7 +53,7 @@ def update(channel: Channel, date: date) -> int:
             text_url_suffix = re.findall(r'href="(.*?)"', text_weibo)[-1]
             text_url = "https://m.weibo.cn" + text_url_suffix
             try:
-                r = requests.get(text_url, headers=headers, timeout=5)
+                r = http.get(text_url, headers=headers)
             except:
                 continue
             render_data = re.findall(
@@ -112,7 +112,6 @@ def update(channel: Channel, date: date) -> int:
             if program.sub_title == "":
                 program.sub_title = sub_title
             program.title = title_dict[sub_title]
-            program.scraper_id = "cctv9@weibo"
             num_updated_programs += 1
 
     if num_updated_programs > 0:
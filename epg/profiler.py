@@ -0,0 +1,206 @@
+"""
+This defines the build profiler.
+It records wall and CPU time by stage, scraper, plugin and upstream host,
+optionally with cProfile and the peak memory from tracemalloc.
+Nothing is recorded unless start() is called, measure() is a no-op then.
+
+Stages run in the main thread, their CPU time is the one of the process, worker threads included.
+Scrapers, plugins and hosts run in worker threads too, their CPU time is the one of their thread.
+Times of nested measures overlap, e.g. a scraper includes the hosts it requested.
+"""
+
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# The number of reports kept in the history
+HISTORY = 100
+
+_enabled = False
+_options: set[str] = set()
+_records: dict[str, dict[str, list]] = {}
+_lock = threading.Lock()
+_started: tuple[float, float, datetime] | None = None
+_cprofile: cProfile.Profile | None = None
+# Peak memory of the open stages, innermost last
+_peaks: list[int] = []
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def start(options: str) -> None:
+    """
+    Start profiling a build.
+
+    Args:
+        options (str): Comma separated options, profiling is off if empty.
+            "cprofile" runs cProfile in the main thread, "memory" traces the peak memory.
+            Any other value records times only.
+    """
+    global _enabled, _options, _started, _cprofile
+    _options = {option.strip() for option in options.split(",")} - {""}
+    _enabled = _options != set()
+    if not _enabled:
+        return
+    with _lock:
+        _records.clear()
+    _peaks.clear()
+    if "memory" in _options:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        _peaks.append(0)
+    _started = (time.perf_counter(), time.process_time(), datetime.now().astimezone())
+    _cprofile = None
+    if "cprofile" in _options:
+        _cprofile = cProfile.Profile()
+        _cprofile.enable()
+
+
+def _add(kind: str, name: str, wall: float, cpu: float, peak: int | None) -> None:
+    with _lock:
+        record = _records.setdefault(kind, {}).setdefault(name, [0.0, 0.0, 0, None])
+        record[0] += wall
+        record[1] += cpu
+        record[2] += 1
+        if peak is not None:
+            record[3] = max(record[3] or 0, peak)
+
+
+@contextmanager
+def measure(kind: str, name: str):
+    """
+    Measure the wall and CPU time of the block, added to the totals of name.
+
+    Args:
+        kind (str): "scrapers", "plugins", "hosts", ...
+        name (str): The name of the scraper, plugin, host...
+    """
+    if not _enabled:
+        yield
+        return
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        _add(kind, name, time.perf_counter() - wall, time.thread_time() - cpu, None)
+
+
+def _fold_peak() -> None:
+    # Record the peak since the last reset in the open stages, then reset it
+    peak = tracemalloc.get_traced_memory()[1]
+    for i in range(len(_peaks)):
+        _peaks[i] = max(_peaks[i], peak)
+    tracemalloc.reset_peak()
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Measure a build stage, in the main thread. The peak memory is recorded with the "memory" option.
+    """
+    if not _enabled:
+        yield
+        return
+    memory = tracemalloc.is_tracing()
+    if memory:
+        _fold_peak()
+        _peaks.append(0)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        peak = None
+        if memory:
+            _fold_peak()
+            peak = _peaks.pop()
+        _add("stages", name, wall, cpu, peak)
+
+
+def stop(dir: str) -> dict | None:
+    """
+    Stop profiling and write the report to dir/profile.json, appended to dir/profile_history.jsonl.
+    With cProfile, the stats are written to dir/profile.prof, to be read with pstats.
+
+    Returns:
+        dict | None: The report, None if profiling is off.
+    """
+    global _enabled, _cprofile
+    if not _enabled:
+        return None
+    _enabled = False
+    os.makedirs(dir, exist_ok=True)
+    if _cprofile is not None:
+        _cprofile.disable()
+        _cprofile.dump_stats(os.path.join(dir, "profile.prof"))
+        _cprofile = None
+    peak = None
+    if tracemalloc.is_tracing():
+        _fold_peak()
+        peak = _peaks.pop()
+        tracemalloc.stop()
+    with _lock:
+        records = {
+            kind: {
+                name: {
+                    "wall": round(wall, 6),
+                    "cpu": round(cpu, 6),
+                    "calls": calls,
+                    **({"peak_memory": stage_peak} if stage_peak is not None else {}),
+                }
+                for name, (wall, cpu, calls, stage_peak) in sorted(
+                    names.items(), key=lambda item: -item[1][0]
+                )
+            }
+            for kind, names in _records.items()
+        }
+    report = {
+        "time": _started[2].isoformat(timespec="seconds"),
+        "wall": round(time.perf_counter() - _started[0], 6),
+        "cpu": round(time.process_time() - _started[1], 6),
+        "peak_memory": peak,
+        "options": sorted(_options),
+        **records,
+    }
+    tmp_path = os.path.join(dir, "profile.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, os.path.join(dir, "profile.json"))
+    history_path = os.path.join(dir, "profile_history.jsonl")
+    try:
+        with open(history_path, "r") as f:
+            history = f.read().splitlines()[-(HISTORY - 1) :]
+    except OSError:
+        history = []
+    history.append(json.dumps(report, separators=(",", ":")))
+    with open(history_path + ".tmp", "w") as f:
+        f.write("\n".join(history) + "\n")
+    os.replace(history_path + ".tmp", history_path)
+    return report
+
+
+def print_report(report: dict) -> None:
+    """
+    Print the stages of a report, then the slowest scrapers, plugins and hosts.
+    """
+    summary = f"profile: wall {report['wall']:.3f}s, cpu {report['cpu']:.3f}s"
+    if report["peak_memory"] is not None:
+        summary += f", peak memory {report['peak_memory']} bytes"
+    print(summary, flush=True)
+    for kind in ("stages", "scrapers", "plugins", "hosts"):
+        for name, record in list(report.get(kind, {}).items())[:10]:
+            print(
+                f"profile {kind} {name}: wall {record['wall']:.3f}s,"
+                f" cpu {record['cpu']:.3f}s, calls {record['calls']}",
+                flush=True,
+            )
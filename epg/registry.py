@@ -0,0 +1,143 @@
+"""
+This defines the registry of scrapers and plugins.
+Modules are imported once, when the config is loaded, instead of on every channel-day.
+A scraper declares its capabilities with module constants, all optional:
+    HOST = "api.cntv.cn"  The upstream host. None if it depends on the scraper id.
+    WINDOW = (-7, 7)      The dates it serves, in days relative to today, both included.
+                          "week" is Monday to Sunday of the current week. None is any date.
+    COST = 1              The relative cost of one call, 1 is one small request.
+It supports date ranges if it defines update_range().
+"""
+
+import importlib
+import threading
+from collections.abc import Callable
+from datetime import date, timedelta
+from epg.model import Channel
+
+WEEK = "week"
+
+
+class Scraper:
+    """
+    A scraper module and its capabilities.
+
+    Attributes:
+        name (str): The module name in epg.scraper.
+        update (Callable): update(channel, scraper_id, dt) -> bool.
+        update_range (Callable | None): update_range(channel, scraper_id, start, end) -> list[date], if supported.
+        host (str | None): The upstream host.
+        window (tuple[int, int] | str | None): The supported dates relative to today.
+        cost (float): The relative cost of one call.
+
+    Methods:
+        supports(day: date, today: date) -> bool: Check if day can be scraped today.
+        opens(day: date, today: date) -> date | None: Get the first day from today on which day can be scraped.
+    """
+
+    __slots__ = ("name", "update", "update_range", "host", "window", "cost")
+
+    def __init__(self, name: str, module) -> None:
+        self.name = name
+        self.update = getattr(module, "update")
+        self.update_range = getattr(module, "update_range", None)
+        self.host = getattr(module, "HOST", None)
+        self.window = getattr(module, "WINDOW", None)
+        self.cost = getattr(module, "COST", 1)
+
+    def supports(self, day: date, today: date) -> bool:
+        return self.opens(day, today) == today
+
+    def opens(self, day: date, today: date) -> date | None:
+        """
+        Get the first day from today on which day is in the window, None if never.
+        """
+        if self.window is None:
+            return today
+        if self.window == WEEK:
+            first = day - timedelta(day.weekday())
+            last = first + timedelta(6)
+        else:
+            first = day - timedelta(self.window[1])
+            last = day - timedelta(self.window[0])
+        if today > last:
+            return None
+        return max(today, first)
+
+
+_scrapers: dict[str, Scraper] = {}
+_plugins: dict[str, Callable] = {}
+_lock = threading.Lock()
+
+
+def scraper(name: str) -> Scraper:
+    """
+    Get the scraper of name, imported on first use.
+
+    Raises:
+        ModuleNotFoundError: If there is no such scraper.
+    """
+    with _lock:
+        if name not in _scrapers:
+            _scrapers[name] = Scraper(
+                name, importlib.import_module("epg.scraper" + "." + name)
+            )
+        return _scrapers[name]
+
+
+def plugin(name: str) -> Callable:
+    """
+    Get the update() function of the plugin of name, imported on first use.
+    """
+    with _lock:
+        if name not in _plugins:
+            _plugins[name] = getattr(
+                importlib.import_module("epg.plugin" + "." + name), "update"
+            )
+        return _plugins[name]
+
+
+def load(channels_config: dict) -> None:
+    """
+    Import the scrapers and plugins of the channels config. Unknown ones are printed.
+    """
+    for channel_id, metadata in channels_config.items():
+        for name in metadata.get("scraper") or {}:
+            try:
+                scraper(name)
+            except ImportError as exc:
+                print(f"unknown scraper {name} of {channel_id}: {exc}", flush=True)
+        if metadata.get("plugin") is not None:
+            try:
+                plugin(metadata["plugin"])
+            except ImportError as exc:
+                print(
+                    f"unknown plugin {metadata['plugin']} of {channel_id}: {exc}",
+                    flush=True,
+                )
+
+
+def scrapers(channel: Channel) -> list[tuple[Scraper, str | None]]:
+    """
+    Get the scrapers of channel in the configured order, with their scraper ids.
+    Unknown scrapers are left out, they are printed by load().
+    """
+    result = []
+    for name, scraper_id in (channel.metadata.get("scraper") or {}).items():
+        try:
+            result.append((scraper(name), scraper_id))
+        except ImportError:
+            continue
+    return result
+
+
+def opens(channel: Channel, day: date, today: date) -> date | None:
+    """
+    Get the first day from today on which any scraper of channel can scrape day, None if never.
+    """
+    first_days = [
+        first_day
+        for first_day in (item[0].opens(day, today) for item in scrapers(channel))
+        if first_day is not None
+    ]
+    return min(first_days, default=None)
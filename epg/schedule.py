@@ -0,0 +1,167 @@
+"""
+This defines the refresh schedule.
+Every channel-day in the recap/preview window of a channel has a due time.
+A build refreshes only the due channel-days, then schedules them again after the interval of their kind:
+recap (a past day), today or preview (a future day). The interval doubles every time
+the programs come back unchanged or the scrap fails, up to 2 ** MAX_BACKOFF times.
+A zero interval backs off from one hour, so failing or unchanged days are not retried on every build.
+A past day is complete once it has programs, and never refreshed again.
+
+Intervals are in hours, set per channel in channels.yaml:
+    interval:
+      today: 3
+      preview: 12
+      recap: 24
+The defaults follow the refresh setting, "today" refreshes today and preview on every build
+while they change, "once" refreshes them once a day. Missing recap days are retried with backoff.
+"""
+
+import heapq
+import math
+from datetime import date, timedelta
+from epg.model import Channel
+
+HOUR = 3600
+MAX_BACKOFF = 4
+DEFAULT_INTERVALS = {
+    "today": {"recap": 0, "today": 0, "preview": 0},
+    "once": {"recap": 0, "today": 24, "preview": 24},
+}
+
+
+def intervals(channel: Channel) -> dict[str, float]:
+    """
+    Get the refresh intervals of channel in hours, by kind of day.
+    """
+    result = dict(
+        DEFAULT_INTERVALS.get(
+            channel.metadata.get("refresh"), DEFAULT_INTERVALS["once"]
+        )
+    )
+    result.update(channel.metadata.get("interval") or {})
+    return result
+
+
+def kind_of(day: date, today: date) -> str:
+    if day < today:
+        return "recap"
+    if day == today:
+        return "today"
+    return "preview"
+
+
+def window(channel: Channel, today: date) -> list[date]:
+    """
+    Get the dates of the recap/preview window of channel.
+    """
+    recap = channel.metadata.get("recap") or 0
+    preview = channel.metadata.get("preview") or 0
+    return [today + timedelta(i) for i in range(-recap, preview + 1)]
+
+
+class Schedule:
+    """
+    Refresh schedule of channel-days, a priority queue by due time.
+
+    Attributes:
+        entries (dict[tuple[str, str], tuple[float, int, str]]): (due time, backoff, kind) by (channel id, date).
+
+    Methods:
+        sync(channels: list[Channel], today: date, now: float) -> None: Add channel-days entering the window.
+        pop_due(now: float) -> dict[str, list[date]]: Take the due dates by channel id.
+        done(channel: Channel, day: date, today: date, now: float, ok: bool, changed: bool) -> None: Schedule a refreshed day again.
+        defer(channel: Channel, day: date, today: date, due: float) -> None: Schedule a day not refreshed yet later.
+        next_due() -> float | None: Get the earliest due time.
+    """
+
+    def __init__(self, entries: dict | None = None) -> None:
+        self.entries: dict[tuple[str, str], tuple[float, int, str]] = entries or {}
+        self.__heap = [
+            (due, key) for key, (due, _, _) in self.entries.items() if due != math.inf
+        ]
+        heapq.heapify(self.__heap)
+
+    def __set(self, key: tuple[str, str], due: float, backoff: int, kind: str) -> None:
+        self.entries[key] = (due, backoff, kind)
+        if due != math.inf:
+            heapq.heappush(self.__heap, (due, key))
+
+    def sync(self, channels: list[Channel], today: date, now: float) -> None:
+        """
+        Make channel-days of the windows due when they are new or change kind, e.g. a preview day becoming today.
+        Complete past days are never due. Entries out of the windows are dropped.
+        """
+        keys = set()
+        for channel in channels:
+            days = channel.programs.days()
+            for day in window(channel, today):
+                key = (channel.id, day.isoformat())
+                keys.add(key)
+                kind = kind_of(day, today)
+                entry = self.entries.get(key)
+                if kind == "recap" and days.get(day):
+                    if entry is None or entry[0] != math.inf:
+                        self.__set(key, math.inf, 0, kind)
+                elif entry is None or entry[2] != kind:
+                    self.__set(key, now, 0, kind)
+        for key in self.entries.keys() - keys:
+            del self.entries[key]
+
+    def pop_due(self, now: float) -> dict[str, list[date]]:
+        """
+        Take the channel-days due at now, in due order.
+        Call done() for each of them after refreshing.
+
+        Returns:
+            dict[str, list[date]]: The sorted due dates by channel id.
+        """
+        due = {}
+        while self.__heap != [] and self.__heap[0][0] <= now:
+            due_time, key = heapq.heappop(self.__heap)
+            entry = self.entries.get(key)
+            # Rescheduled or dropped since pushed
+            if entry is None or entry[0] != due_time:
+                continue
+            due.setdefault(key[0], set()).add(date.fromisoformat(key[1]))
+        return {channel_id: sorted(dates) for channel_id, dates in due.items()}
+
+    def done(
+        self,
+        channel: Channel,
+        day: date,
+        today: date,
+        now: float,
+        ok: bool,
+        changed: bool,
+    ) -> None:
+        """
+        Schedule a refreshed channel-day again. Back off if it failed or did not change.
+        """
+        key = (channel.id, day.isoformat())
+        kind = kind_of(day, today)
+        if kind == "recap" and ok:
+            self.__set(key, math.inf, 0, kind)
+            return
+        backoff = 0
+        if key in self.entries and (not ok or not changed):
+            backoff = min(self.entries[key][1] + 1, MAX_BACKOFF)
+        interval = intervals(channel)[kind]
+        if backoff > 0:
+            interval = max(interval, 1) * 2**backoff
+        interval *= HOUR
+        self.__set(key, now + interval, backoff, kind)
+
+    def defer(self, channel: Channel, day: date, today: date, due: float) -> None:
+        """
+        Schedule a channel-day that could not be refreshed yet at due, keeping its backoff.
+        """
+        key = (channel.id, day.isoformat())
+        backoff = self.entries[key][1] if key in self.entries else 0
+        self.__set(key, due, backoff, kind_of(day, today))
+
+    def next_due(self) -> float | None:
+        while self.__heap != [] and (
+            self.entries.get(self.__heap[0][1], (None,))[0] != self.__heap[0][0]
+        ):
+            heapq.heappop(self.__heap)
+        return self.__heap[0][0] if self.__heap != [] else None
@@ -0,0 +1,210 @@
+"""
+Disk cache of scraper HTTP responses, shared by builds.
+Entries are fresh for a TTL depending on the date they are about,
+then revalidated with ETag/Last-Modified when upstream supports it.
+A past date keeps the short TTL until its scraper confirms it parsed programs from the body,
+so an error payload or an empty schedule is not kept for long.
+The least recently used entries are evicted above the size cap.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import date, datetime
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+CACHE_DIR = os.getenv(
+    "HTTP_CACHE_DIR", os.path.join(os.getcwd(), "config", "cache", "http")
+)
+CACHE_SIZE = int(os.getenv("HTTP_CACHE_SIZE", "256")) * 1024 * 1024  # MB
+
+TTL_PAST = 30 * 86400  # past schedules don't change, keep until evicted
+TTL_TODAY = 3600
+TTL_UNCONFIRMED = TTL_TODAY  # past schedules not parsed yet
+TTL_FUTURE = 6 * 3600
+
+_lock = threading.Lock()
+_size: int | None = None
+
+
+def enabled() -> bool:
+    return CACHE_DIR != "" and CACHE_SIZE > 0
+
+
+def ttl_for(dt: date) -> int:
+    """
+    Get the TTL of a response about the schedule of the given date.
+    """
+    today = datetime.now().date()
+    if dt < today:
+        return TTL_PAST
+    if dt == today:
+        return TTL_TODAY
+    return TTL_FUTURE
+
+
+def key(method: str, url: str, params=None, data=None, scope: str = "") -> str:
+    """
+    Build the cache key of a request.
+    scope tells apart the same url requested for different dates.
+    """
+    raw = json.dumps(
+        [method, url, params, data, scope], sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _paths(key: str) -> tuple[str, str]:
+    return (
+        os.path.join(CACHE_DIR, key[:2], key + ".json"),
+        os.path.join(CACHE_DIR, key[:2], key + ".body"),
+    )
+
+
+def load(key: str) -> dict | None:
+    """
+    Load a cache entry, and mark it as recently used.
+
+    Returns:
+        dict | None: The entry metadata with the body under "content", or None if missing.
+    """
+    meta_path, body_path = _paths(key)
+    try:
+        with open(meta_path, "r") as f:
+            entry = json.load(f)
+        with open(body_path, "rb") as f:
+            entry["content"] = f.read()
+        os.utime(meta_path)
+    except (OSError, ValueError):
+        return None
+    return entry
+
+
+def is_fresh(entry: dict) -> bool:
+    return entry["expires"] > time.time()
+
+
+def validators(entry: dict) -> dict:
+    """
+    Get conditional request headers to revalidate an entry.
+    """
+    headers = {}
+    if entry["headers"].get("ETag"):
+        headers["If-None-Match"] = entry["headers"]["ETag"]
+    if entry["headers"].get("Last-Modified"):
+        headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+    return headers
+
+
+def to_response(entry: dict) -> Response:
+    response = Response()
+    response.status_code = 200
+    response.url = entry["url"]
+    response.headers = CaseInsensitiveDict(entry["headers"])
+    response.encoding = entry["encoding"]
+    response._content = entry["content"]
+    return response
+
+
+def store(key: str, response: Response, ttl: int) -> None:
+    """
+    Store a response, then evict least recently used entries over the size cap.
+    """
+    meta_path, body_path = _paths(key)
+    entry = {
+        "url": response.url,
+        "encoding": response.encoding,
+        "headers": {
+            name: response.headers[name]
+            for name in ("Content-Type", "ETag", "Last-Modified")
+            if name in response.headers
+        },
+        "expires": time.time() + ttl,
+    }
+    content = response.content
+    try:
+        old_size = os.path.getsize(body_path)
+    except OSError:
+        old_size = 0
+    try:
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        _write(body_path, content)
+        _write(meta_path, json.dumps(entry).encode())
+    except OSError as e:
+        print("Fail to cache:", response.url, e)
+        return
+    # An overwritten entry is already counted
+    _grow(len(content) - old_size)
+
+
+def touch(key: str, entry: dict, ttl: int, confirmed: bool = False) -> None:
+    """
+    Extend the freshness of an entry after upstream answered 304 Not Modified,
+    or after its scraper confirmed it parsed programs from it.
+    """
+    meta_path, _ = _paths(key)
+    entry = {k: v for k, v in entry.items() if k != "content"}
+    entry["expires"] = time.time() + ttl
+    if confirmed:
+        entry["confirmed"] = True
+    try:
+        _write(meta_path, json.dumps(entry).encode())
+    except OSError:
+        pass
+
+
+def _write(path: str, content: bytes) -> None:
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _entries() -> list[tuple[float, int, str]]:
+    """
+    List entries as (last used time, size, key).
+    """
+    entries = []
+    for root, _, files in os.walk(CACHE_DIR):
+        for file in files:
+            if not file.endswith(".json"):
+                continue
+            key = file[: -len(".json")]
+            meta_path, body_path = _paths(key)
+            try:
+                entries.append(
+                    (
+                        os.path.getmtime(meta_path),
+                        os.path.getsize(body_path),
+                        key,
+                    )
+                )
+            except OSError:
+                continue
+    return entries
+
+
+def _grow(size: int) -> None:
+    global _size
+    with _lock:
+        if _size is None:
+            _size = sum(entry[1] for entry in _entries())
+        else:
+            _size += size
+        if _size <= CACHE_SIZE:
+            return
+        # Evict down to 90% of the cap, so it does not happen on every store
+        entries = sorted(_entries())
+        _size = sum(entry[1] for entry in entries)
+        for _, entry_size, key in entries:
+            if _size <= CACHE_SIZE * 0.9:
+                break
+            for path in _paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            _size -= entry_size
@@ -0,0 +1,326 @@
+"""
+Shared HTTP client for scrapers and plugins.
+One keep-alive connection pool per host, a cap on concurrent requests per host,
+and a small DNS cache, so a build reuses a handful of connections.
+Responses can be kept in the disk cache of epg.scraper.__cache.
+A circuit breaker per host fails fast while an upstream is down: after BREAKER_THRESHOLD
+consecutive timeouts, connection errors or 5xx responses, requests to the host raise
+CircuitOpenError for BREAKER_COOLDOWN seconds, then one probe request decides whether it is back.
+"""
+
+import os
+import socket
+import threading
+import time
+from datetime import date
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import (
+    ConnectTimeoutError,
+    NameResolutionError,
+    NewConnectionError,
+)
+from urllib.parse import urlsplit
+from epg import profiler
+from . import headers
+from . import __cache as cache
+
+MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "4"))
+DNS_TTL = 300
+TIMEOUT = 5
+# 0 disables the circuit breaker
+BREAKER_THRESHOLD = int(os.getenv("HTTP_BREAKER_THRESHOLD", "3"))
+BREAKER_COOLDOWN = int(os.getenv("HTTP_BREAKER_COOLDOWN", "60"))
+
+_dns_cache: dict[tuple, tuple[float, str]] = {}
+_dns_lock = threading.Lock()
+
+
+def _cached_address(host: str, port: int) -> str | None:
+    with _dns_lock:
+        cached = _dns_cache.get((host, port))
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+    return None
+
+
+def _forget_address(host: str, port: int) -> None:
+    with _dns_lock:
+        _dns_cache.pop((host, port), None)
+
+
+class _CachedDNSConnection:
+    """
+    Connection mixin resolving hosts through the DNS cache.
+    TLS still uses the hostname for SNI and certificate checks, only the TCP connect uses the address.
+    """
+
+    def _new_conn(self):
+        host, port = self._dns_host, self.port
+        address = _cached_address(host, port)
+        if address is not None:
+            self._dns_host = address
+            try:
+                return super()._new_conn()
+            except NewConnectionError:
+                # Refused or unreachable, maybe a stale address: resolve again below
+                _forget_address(host, port)
+            except ConnectTimeoutError:
+                # Resolving again would only time out again
+                _forget_address(host, port)
+                raise
+            finally:
+                self._dns_host = host
+        try:
+            address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+        except socket.gaierror as exc:
+            raise NameResolutionError(self.host, self, exc) from exc
+        with _dns_lock:
+            _dns_cache[(host, port)] = (time.monotonic() + DNS_TTL, address)
+        self._dns_host = address
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+
+class _HTTPConnection(_CachedDNSConnection, HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_CachedDNSConnection, HTTPSConnection):
+    pass
+
+
+class _HTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+class _CachedDNSAdapter(HTTPAdapter):
+    """
+    Adapter whose connections use the DNS cache. Only the shared session mounts it,
+    other urllib3 users in the process resolve as usual.
+    """
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _HTTPConnectionPool,
+            "https": _HTTPSConnectionPool,
+        }
+
+
+_session = requests.Session()
+_session.headers.update(headers)
+_adapter = _CachedDNSAdapter(pool_connections=16, pool_maxsize=MAX_PER_HOST)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+_host_slots: dict[str, threading.BoundedSemaphore] = {}
+_host_slots_lock = threading.Lock()
+
+
+def _slot(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(MAX_PER_HOST)
+        return _host_slots[host]
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised instead of sending a request to a host whose circuit is open.
+    """
+
+
+class _Circuit:
+    """
+    Circuit breaker of a host: closed, open, then half-open when the cooldown is over.
+    In half-open, one probe request at a time is sent, it closes or opens the circuit again.
+    """
+
+    __slots__ = ("host", "state", "failures", "opened_at", "probing", "lock")
+
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def __move(self, state: str, reason: str = "") -> None:
+        print(
+            f"circuit {self.host}: {self.state} -> {state} {reason}".rstrip(),
+            flush=True,
+        )
+        self.state = state
+
+    def allow(self) -> bool:
+        """
+        Check if a request can be sent now.
+        """
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+                    return False
+                self.__move("half-open")
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, ok: bool | None) -> None:
+        """
+        Record the result of a request: True if the host answered, False if it failed,
+        None if the request failed before reaching the host.
+        """
+        with self.lock:
+            self.probing = False
+            if ok is None:
+                return
+            if ok:
+                self.failures = 0
+                if self.state != "closed":
+                    self.__move("closed")
+                return
+            self.failures += 1
+            if self.state == "half-open" or (
+                self.state == "closed" and self.failures >= BREAKER_THRESHOLD
+            ):
+                self.opened_at = time.monotonic()
+                self.__move(
+                    "open",
+                    f"after {self.failures} failures, retry in {BREAKER_COOLDOWN}s",
+                )
+
+
+_circuits: dict[str, _Circuit] = {}
+_circuits_lock = threading.Lock()
+
+
+def _circuit(url: str) -> _Circuit:
+    host = urlsplit(url).netloc
+    with _circuits_lock:
+        if host not in _circuits:
+            _circuits[host] = _Circuit(host)
+        return _circuits[host]
+
+
+def _send(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", TIMEOUT)
+    with profiler.measure("hosts", urlsplit(url).netloc):
+        return _send_checked(method, url, **kwargs)
+
+
+def _send_checked(method: str, url: str, **kwargs) -> requests.Response:
+    if BREAKER_THRESHOLD <= 0:
+        with _slot(url):
+            return _session.request(method, url, **kwargs)
+    circuit = _circuit(url)
+    if not circuit.allow():
+        raise CircuitOpenError(f"circuit of {circuit.host} is open")
+    try:
+        with _slot(url):
+            response = _session.request(method, url, **kwargs)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        circuit.record(False)
+        raise
+    except Exception:
+        circuit.record(None)
+        raise
+    circuit.record(response.status_code < 500)
+    return response
+
+
+def request(
+    method: str,
+    url: str,
+    cache_date: date | None = None,
+    cache_ttl: int | None = None,
+    **kwargs,
+) -> requests.Response:
+    """
+    Send a request through the shared session.
+    Common headers are sent by default, and merged with the given headers.
+    Cached if cache_date or cache_ttl is given. A stale entry is revalidated
+    with ETag/Last-Modified if upstream sent them, otherwise fetched again.
+    A past date is cached for long only once the scraper calls keep() with the response.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The url.
+        cache_date (date, optional): The date of the schedule requested. It sets the TTL:
+            long for past dates, short for today, medium for future dates.
+        cache_ttl (int, optional): The TTL in seconds, if the response is not about a date.
+            0 means always revalidate.
+        **kwargs: Passed to requests.Session.request. timeout defaults to 5 seconds.
+
+    Returns:
+        requests.Response: The response.
+    """
+    if cache_date is not None:
+        cache_ttl = cache.ttl_for(cache_date)
+    past = cache_ttl == cache.TTL_PAST
+    if cache_ttl is None or not cache.enabled():
+        return _send(method, url, **kwargs)
+    key = cache.key(
+        method,
+        url,
+        kwargs.get("params"),
+        kwargs.get("data"),
+        str(cache_date or ""),
+    )
+    entry = cache.load(key)
+    # A past date is kept for long only once keep() confirms the body
+    if past and not (entry or {}).get("confirmed"):
+        cache_ttl = cache.TTL_UNCONFIRMED
+    if entry is not None and cache.is_fresh(entry):
+        response = cache.to_response(entry)
+    else:
+        if entry is not None:
+            kwargs["headers"] = {
+                **cache.validators(entry),
+                **kwargs.get("headers", {}),
+            }
+        response = _send(method, url, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            cache.touch(key, entry, cache_ttl)
+            response = cache.to_response(entry)
+        elif response.status_code == 200:
+            entry = None
+            cache.store(key, response, cache.TTL_UNCONFIRMED if past else cache_ttl)
+        else:
+            return response
+    if past and not (entry or {}).get("confirmed"):
+        response.cache_key = key
+    return response
+
+
+def keep(response: requests.Response) -> None:
+    """
+    Cache the response of a past date for long, once the scraper parsed programs from it.
+    """
+    key = getattr(response, "cache_key", None)
+    if key is None:
+        return
+    entry = cache.load(key)
+    if entry is not None:
+        cache.touch(key, entry, cache.TTL_PAST, True)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
@@ -1,6 +1,10 @@
 """
 This folder contains all the scrapers.
 Define update(channel: Channel, scraper_id: str | None = None, dt: date) is necessary.
+Define update_range(channel: Channel, scraper_id: str | None, start: date, end: date) -> list[date] is optional,
+if the source returns several days in one request. It returns the updated dates.
+HOST, WINDOW and COST declare the capabilities of the scraper, see epg.registry.
+Send requests through epg.scraper.__http to share connection pools and headers.
 """
 
 from zoneinfo import ZoneInfo
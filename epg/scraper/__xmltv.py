@@ -1,67 +1,133 @@
-import requests
 from lxml import etree
 from epg.model import Channel, Program
 from datetime import datetime
 from io import BytesIO
-from . import headers
+from . import __http as http
 from epg.scraper import tz_shanghai
 
 
-def get_channels(xmltv_url: str, dtd: etree.DTD | None = None) -> list[Channel]:
+def get_channels(
+    xmltv_url: str,
+    dtd: etree.DTD | None = None,
+    channel_ids: set[str] | None = None,
+) -> list[Channel]:
+    """
+    Get channels and their programs from an XMLTV url.
+
+    Args:
+        xmltv_url (str): The XMLTV url.
+        dtd (etree.DTD, optional): Validate the XMLTV with this DTD.
+        channel_ids (set[str], optional): Only keep these channels. Defaults to all channels.
+
+    Returns:
+        list[Channel]: The channels, or [] if the XMLTV can't be got or is not valid.
+    """
     try:
-        xml = requests.get(xmltv_url, headers=headers, timeout=5).content
+        xml = http.get(xmltv_url, cache_ttl=0).content
     except:
         print("Failed to get XMLTV")
         return []
-    if dtd != None:
-        xml_bytes = BytesIO(xml)
-        try:
-            root = etree.XML(xml_bytes.read())
-        except:
-            print("XML is not valid")
-            return []
-        valid = dtd.validate(root)
-        if not valid:
-            print(dtd.error_log.filter_from_errors()[0])
-            return []
-    root = etree.XML(xml)
+    return parse_channels(BytesIO(xml), dtd, channel_ids)
+
+
+def parse_channels(
+    source,
+    dtd: etree.DTD | None = None,
+    channel_ids: set[str] | None = None,
+) -> list[Channel]:
+    """
+    Parse XMLTV in one streaming pass.
+    Programmes are bucketed by channel as they arrive, and elements are freed once processed.
+    With a DTD, every channel and programme element is validated as it is parsed,
+    and channels must come before programmes, as in the DTD.
+
+    Args:
+        source: A file name or file-like object of the XMLTV.
+        dtd (etree.DTD, optional): Validate the XMLTV with this DTD.
+        channel_ids (set[str], optional): Only keep these channels. Defaults to all channels.
+
+    Returns:
+        list[Channel]: The channels, or [] if the XMLTV is not valid.
+    """
+    last_update = datetime(1970, 1, 1, 0, 0, 0, tzinfo=tz_shanghai)
+    channel_names = {}
+    programs = {}
+    in_programmes = False
     try:
-        last_update = datetime.strptime(root.get("date"), "%Y%m%d%H%M%S %z")
-    except (TypeError, ValueError) as e:
-        last_update = datetime(1970, 1, 1, 0, 0, 0, tzinfo=tz_shanghai)
+        for event, element in etree.iterparse(
+            source,
+            events=("start", "end"),
+            tag=("tv", "channel", "programme"),
+            huge_tree=True,
+        ):
+            if element.tag == "tv":
+                if event == "start":
+                    try:
+                        last_update = datetime.strptime(
+                            element.get("date"), "%Y%m%d%H%M%S %z"
+                        )
+                    except (TypeError, ValueError) as e:
+                        pass
+                elif dtd != None:
+                    # Children are validated already, only attributes are left
+                    del element[:]
+                    if not dtd.validate(element):
+                        print(dtd.error_log.filter_from_errors()[0])
+                        return []
+                continue
+            if event == "start":
+                continue
+            if dtd != None and not dtd.validate(element):
+                print(dtd.error_log.filter_from_errors()[0])
+                return []
+            # Elements are validated one by one, so check the (channel*, programme*) order here
+            if dtd != None and element.tag == "channel" and in_programmes:
+                print("channel", element.get("id"), "after programmes")
+                return []
+            if element.tag == "channel":
+                channel_id = element.get("id")
+                if channel_ids is None or channel_id in channel_ids:
+                    channel_names[channel_id] = [
+                        x.text for x in element.iter("display-name")
+                    ]
+            else:
+                in_programmes = True
+                channel_id = element.get("channel")
+                if channel_ids is None or channel_id in channel_ids:
+                    programs.setdefault(channel_id, []).append(
+                        parse_programme(element, channel_id)
+                    )
+            # Free processed elements
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    except etree.XMLSyntaxError:
+        print("XML is not valid")
+        return []
     channels = []
-    for xml_channel in root.iter("channel"):
-        channel_id = xml_channel.get("id")
-        channel_names = [x.text for x in xml_channel.iter("display-name")]
-        metadata = {"name": channel_names}
-        channels.append(Channel(channel_id, metadata))
-    for channel in channels:
+    for channel_id, names in channel_names.items():
+        channel = Channel(channel_id, {"name": names})
         channel.metadata.update({"last_update": last_update})
-        xml_programmes = root.xpath(f"//programme[@channel='{channel.id}']")
-        for xml_programme in xml_programmes:
-            start_time = datetime.strptime(
-                xml_programme.get("start"), "%Y%m%d%H%M%S %z"
-            )
-            end_time = datetime.strptime(xml_programme.get("stop"), "%Y%m%d%H%M%S %z")
-            title = xml_programme.find("title").text
-            try:
-                sub_title = xml_programme.find("sub-title").text
-            except:
-                sub_title = ""
-            desc = (
-                xml_programme.find("desc").text
-                if xml_programme.find("desc") is not None
-                else ""
-            )
-            channel.programs.append(
-                Program(
-                    title,
-                    start_time,
-                    end_time,
-                    channel.id + "@xmltv",
-                    desc,
-                    sub_title=sub_title,
-                )
-            )
-            channel.programs.sort(key=lambda x: x.start_time)
+        channel.programs = programs.get(channel_id, [])
+        channel.programs.sort(key=lambda x: x.start_time)
+        channels.append(channel)
     return channels
+
+
+def parse_programme(xml_programme: etree._Element, channel_id: str) -> Program:
+    """
+    Parse a programme element.
+    """
+    start_time = datetime.strptime(xml_programme.get("start"), "%Y%m%d%H%M%S %z")
+    end_time = datetime.strptime(xml_programme.get("stop"), "%Y%m%d%H%M%S %z")
+    title = xml_programme.findtext("title")
+    sub_title = xml_programme.findtext("sub-title", "")
+    desc = xml_programme.findtext("desc", "")
+    return Program(
+        title,
+        start_time,
+        end_time,
+        channel_id + "@xmltv",
+        desc,
+        sub_title=sub_title,
+    )
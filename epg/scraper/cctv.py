@@ -1,18 +1,21 @@
 from epg.model import Channel, Program
 from datetime import datetime, date, timezone
-import requests
 import json
-from . import headers, tz_shanghai
+from . import tz_shanghai
+from . import __http as http
+
+HOST = "api.cntv.cn"
 
 
 def update(
-    channel: Channel, scraper_id: str | None = None, dt: date = datetime.today().date()
+    channel: Channel, scraper_id: str | None = None, dt: date | None = None
 ) -> bool:
+    dt = datetime.today().date() if dt is None else dt
     channel_id = channel.id if scraper_id == None else scraper_id
     date_str = dt.strftime("%Y%m%d")
     url = f"http://api.cntv.cn/epg/getEpgInfoByChannelNew?c={channel_id}&serviceId=tvcctv&d={date_str}&t=json"
     try:
-        res = requests.get(url, headers=headers, timeout=5)
+        res = http.get(url, cache_date=dt)
     except:
         print("Fail:", url)
         return False
@@ -35,4 +38,6 @@ def update(
             Program(title, start_time, end_time, channel.id + "@tv.cctv.com")
         )
     channel.metadata.update({"last_update": datetime.now(timezone.utc).astimezone()})
+    if len(programs_data) > 0:
+        http.keep(res)
     return True
@@ -1,19 +1,21 @@
 from epg.model import Channel, Program
 from datetime import datetime, date, timedelta
-import requests
-from . import headers, tz_shanghai
+from . import tz_shanghai
+from . import __http as http
 
 API_ENDPOINT = "https://www.discoverychannel.com.tw/ajax/getschedule.php"
+HOST = "www.discoverychannel.com.tw"
 
 
 def update(
-    channel: Channel, scraper_id: str | None = None, dt: date = datetime.today().date()
+    channel: Channel, scraper_id: str | None = None, dt: date | None = None
 ) -> bool:
+    dt = datetime.today().date() if dt is None else dt
     channel_id = channel.id if scraper_id == None else scraper_id
     date_str = dt.strftime("%Y-%m-%d")
     r_data = {"date": date_str, "channel": channel_id}
     try:
-        res = requests.post(API_ENDPOINT, data=r_data, headers=headers, timeout=5)
+        res = http.post(API_ENDPOINT, data=r_data, cache_date=dt)
     except:
         print("Fail:", API_ENDPOINT)
         return False
@@ -43,4 +45,5 @@ def update(
         tz_shanghai
     ).replace(year=dt.year, month=dt.month, day=dt.day) + timedelta(days=1)
     channel.programs.append(temp_program)
+    http.keep(res)
     return True
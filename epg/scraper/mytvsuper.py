@@ -2,13 +2,14 @@
 # Channels: https://github.com/iptv-org/epg/blob/master/sites/mytvsuper.com/mytvsuper.com.channels.xml
 # Translated by: https://chat.openai.com/share/e1a723db-d273-4241-97b9-cf8497b5c746
 
-import requests
 import datetime
 import json
 from epg.model import Channel, Program
 from . import tz_hong_kong
+from . import __http as http
 
 API_ENDPOINT = "https://content-api.mytvsuper.com/v1"
+HOST = "content-api.mytvsuper.com"
 
 
 def parse_title(item, site_channel):
@@ -52,9 +53,12 @@ def parse_items(content, date):
     return day_data["epg"]
 
 
-def fetch_data(site_channel, date):
-    url = f"{API_ENDPOINT}/epg?network_code={site_channel['site_id']}&from={date.strftime('%Y%m%d')}&to={date.strftime('%Y%m%d')}&platform=web"
-    response = requests.get(url)
+def fetch_data(site_channel, date, end_date=None):
+    end_date = date if end_date is None else end_date
+    url = f"{API_ENDPOINT}/epg?network_code={site_channel['site_id']}&from={date.strftime('%Y%m%d')}&to={end_date.strftime('%Y%m%d')}&platform=web"
+    # Cache for the shortest TTL of the range: today if in it, the closest date to today otherwise
+    today = datetime.date.today()
+    response = http.get(url, cache_date=min(max(today, date), end_date))
     response.raise_for_status()
     return response.text
 
@@ -89,7 +93,7 @@ def parse_programs(content, site_channel, date):
 
 
 def get_channels(lang):
-    response = requests.get(f"{API_ENDPOINT}/channel/list?platform=web")
+    response = http.get(f"{API_ENDPOINT}/channel/list?platform=web")
     response.raise_for_status()
     data = response.json()
 
@@ -107,8 +111,9 @@ def get_channels(lang):
 def update(
     channel: Channel,
     scraper_id: str | None = None,
-    dt: datetime.date = datetime.datetime.today().date(),
+    dt: datetime.date | None = None,
 ) -> bool:
+    dt = datetime.datetime.today().date() if dt is None else dt
     channel_id = channel.id if scraper_id == None else scraper_id
     lang = channel.metadata.get("lang", "tc")
     # Purge channel programs on this date
@@ -123,7 +128,46 @@ def update(
         data = fetch_data(site_channel, dt)
     except:
         return False
-    programs = parse_programs(data, site_channel, dt)
+    append_programs(channel, parse_programs(data, site_channel, dt), channel_id)
+    channel.metadata.update({"last_update": datetime.datetime.now().astimezone()})
+    return True
+
+
+def update_range(
+    channel: Channel,
+    scraper_id: str | None,
+    start: datetime.date,
+    end: datetime.date,
+) -> list[datetime.date]:
+    """
+    Update channel for every date from start to end with one request.
+
+    Returns:
+        list[date]: The updated dates.
+    """
+    channel_id = channel.id if scraper_id == None else scraper_id
+    lang = channel.metadata.get("lang", "tc")
+    site_channel = {
+        "site_id": channel_id,
+        "lang": lang,
+    }
+
+    try:
+        data = fetch_data(site_channel, start, end)
+    except:
+        return []
+    dates = []
+    dt = start
+    while dt <= end:
+        channel.flush(dt)
+        append_programs(channel, parse_programs(data, site_channel, dt), channel_id)
+        dates.append(dt)
+        dt += datetime.timedelta(days=1)
+    channel.metadata.update({"last_update": datetime.datetime.now().astimezone()})
+    return dates
+
+
+def append_programs(channel: Channel, programs: list, channel_id: str) -> None:
     for program in programs:
         channel.programs.append(
             Program(
@@ -135,5 +179,3 @@ def update(
                 program["episode"],
             )
         )
-    channel.metadata.update({"last_update": datetime.datetime.now().astimezone()})
-    return True
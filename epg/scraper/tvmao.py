@@ -1,14 +1,17 @@
-import requests
 import time
 from datetime import date, datetime, timedelta
-from epg.scraper import headers
+from epg.scraper import __http as http
 from epg.model import Channel, Program
 from . import tz_shanghai
 
+HOST = "lighttv.tvmao.com"
+# Only the days of the current week, Monday to Sunday
+WINDOW = "week"
+
 
 # Credits to https://github.com/supzhang/epg/blob/master/crawl/spiders/tvmao.py
 def update(
-    channel: Channel, scraper_id: str | None = None, dt: date = datetime.today().date()
+    channel: Channel, scraper_id: str | None = None, dt: date | None = None
 ) -> bool:
     """
     Update channel with new data for the given date.
@@ -21,6 +24,7 @@ def update(
     Returns:
         bool: True if success, False if not.
     """
+    dt = datetime.today().date() if dt is None else dt
     now_date = datetime.now().date()
     request_date = dt
     delta = request_date - now_date
@@ -42,7 +46,7 @@ def update(
     url = f"https://lighttv.tvmao.com/qa/qachannelschedule?epgCode={id}&op=getProgramByChnid&epgName=&isNew=on&day={need_weekday}"
     # time.sleep(1)  # 防止 被BAN
     try:
-        res = requests.get(url, headers=headers, timeout=5)
+        res = http.get(url, cache_date=dt)
     except:
         return False
     if res.status_code != 200:
@@ -74,4 +78,5 @@ def update(
         tz_shanghai
     ).replace(year=dt.year, month=dt.month, day=dt.day) + timedelta(days=1)
     channel.programs.append(temp_program)
+    http.keep(res)
     return True
@@ -1,25 +1,31 @@
 from epg.model import Channel, Program
 from datetime import datetime, date, timedelta
-import requests
 from bs4 import BeautifulSoup
-from . import tz_shanghai, headers
+from . import tz_shanghai
+from . import __http as http
 
 baseurl = "https://www.tvsou.com/epg/"
+HOST = "www.tvsou.com"
+# Only the days of the current week, Monday to Sunday
+WINDOW = "week"
+# A full web page to parse
+COST = 2
 
 
-def grab_programs(channel_id: str, need_weekday: int) -> tuple:
+def grab_programs(
+    channel_id: str, need_weekday: int, dt: date | None = None
+) -> tuple:
     """
     Grab programs from tvsou.com.
     Return: (content, date) in tuple
     Args:
         channel_id (str): The channel id.
         need_weekday (int): The weekday to grab.
+        dt (date, optional): The date of the weekday, to cache the page.
     """
     channel_baseurl = baseurl + channel_id + "/"  # get channel_id
     try:
-        res = requests.get(
-            channel_baseurl + "w" + str(need_weekday), headers=headers, timeout=5
-        )
+        res = http.get(channel_baseurl + "w" + str(need_weekday), cache_date=dt)
     except:
         return False
     content = None
@@ -38,6 +44,8 @@ def grab_programs(channel_id: str, need_weekday: int) -> tuple:
             )
         except AttributeError:
             return False
+        if len(content) > 0:
+            http.keep(res)
     return (content, date)
 
 
@@ -81,9 +89,7 @@ def parse_programs(content: tuple) -> list:
     return programs
 
 
-def update(
-    channel: Channel, scraper_id: str | None = None, dt: date = datetime.today().date()
-):
+def update(channel: Channel, scraper_id: str | None = None, dt: date | None = None):
     """
     Update channel with new data for the given date.
     Return: True if success, False if not.
@@ -92,6 +98,7 @@ def update(
         scraper_id (str): The scraper id.
         dt (date): The date to update.
     """
+    dt = datetime.today().date() if dt is None else dt
     now_date = datetime.now().date()
     request_date = dt
     delta = request_date - now_date
@@ -103,7 +110,7 @@ def update(
     if delta.days > 0:
         if delta.days > 6 - now_weekday:
             return False
-    bs_programs = grab_programs(scraper_id, need_weekday)
+    bs_programs = grab_programs(scraper_id, need_weekday, dt)
     if not bs_programs:
         return False
     else:
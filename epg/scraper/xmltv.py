@@ -1,34 +1,72 @@
-import __xmltv
+from . import __xmltv
 from epg.model import Channel, Program
 from datetime import datetime, date, timezone
+import threading
 
+# Parsed sources of this run: url -> channel id -> date -> programs
+_sources: dict[str, dict[str, dict[date, list[Program]]]] = {}
+_url_locks: dict[str, threading.Lock] = {}
+_lock = threading.Lock()
 
-def update(
-    channel: Channel, scraper_params: str, dt: date = datetime.today().date()
-) -> bool:
+
+def get_source(scraper_url: str) -> dict[str, dict[date, list[Program]]]:
+    """
+    Get the programs of an XMLTV source, indexed by channel id and date.
+    The source is downloaded and parsed only once per run.
+
+    Args:
+        scraper_url (str): The XMLTV url.
+
+    Returns:
+        dict[str, dict[date, list[Program]]]: The programs by channel id and date.
+    """
+    with _lock:
+        url_lock = _url_locks.setdefault(scraper_url, threading.Lock())
+    with url_lock:
+        if scraper_url not in _sources:
+            index = {}
+            for scraper_channel in __xmltv.get_channels(scraper_url):
+                days = index.setdefault(scraper_channel.id, {})
+                for program in scraper_channel.programs:
+                    days.setdefault(program.start_time.date(), []).append(program)
+            _sources[scraper_url] = index
+        return _sources[scraper_url]
+
+
+def clear() -> None:
+    """
+    Forget the parsed sources and their locks, so the next run downloads them again.
+    """
+    with _lock:
+        _sources.clear()
+        _url_locks.clear()
+
+
+def update(channel: Channel, scraper_params: str, dt: date | None = None) -> bool:
+    dt = datetime.today().date() if dt is None else dt
+    scraper_id = None
     if scraper_params.find("@http") == -1:
         scraper_url = scraper_params
     else:
         scraper_id = scraper_params.split("@http", 1)[0]
         scraper_url = "http" + scraper_params.split("@http", 1)[1]
     channel_id = channel.id if scraper_id == None else scraper_id
-    scraper_channels = __xmltv.get_channels(scraper_url)
-    for scraper_channel in scraper_channels:
-        if scraper_channel.id == channel_id:
-            for program in scraper_channel.programs:
-                start_time = program.start_time
-                if start_time.date() != dt:
-                    continue
-                end_time = program.end_time
-                title = program.title
-                # Purge channel programs on this date
-                channel.flush(dt)
-                # Update channel programs on this date
-                channel.programs.append(
-                    Program(title, start_time, end_time, channel.id)
-                )
-        channel.metadata.update(
-            {"last_update": datetime.now(timezone.utc).astimezone()}
+    days = get_source(scraper_url).get(channel_id)
+    if days is None or dt not in days:
+        return False
+    # Purge channel programs on this date
+    channel.flush(dt)
+    # Update channel programs on this date
+    for program in days.get(dt, []):
+        channel.programs.append(
+            Program(
+                program.title,
+                program.start_time,
+                program.end_time,
+                channel.id,
+                program.desc,
+                sub_title=program.sub_title,
+            )
         )
-        return True
-    return False
+    channel.metadata.update({"last_update": datetime.now(timezone.utc).astimezone()})
+    return True
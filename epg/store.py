@@ -0,0 +1,269 @@
+"""
+This defines the local program store.
+Programs are kept in SQLite between runs, keyed by channel and date,
+so a build loads only the recap/preview window it needs and writes back only the channel-days that changed.
+"""
+
+import hashlib
+import sqlite3
+from datetime import datetime, date, timedelta, timezone
+from epg.model import Channel, Program
+from epg.schedule import Schedule
+from epg.scraper import tz_shanghai
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS programs (
+    channel TEXT NOT NULL,
+    date TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    start_offset INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    stop_offset INTEGER NOT NULL,
+    title TEXT,
+    sub_title TEXT,
+    desc TEXT,
+    episode,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS programs_channel_start ON programs (channel, start);
+CREATE INDEX IF NOT EXISTS programs_channel_date ON programs (channel, date);
+CREATE TABLE IF NOT EXISTS channel_days (
+    channel TEXT NOT NULL,
+    date TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (channel, date)
+);
+CREATE TABLE IF NOT EXISTS channels (
+    id TEXT PRIMARY KEY,
+    last_update TEXT NOT NULL,
+    last_scraper TEXT
+);
+CREATE TABLE IF NOT EXISTS refresh_schedule (
+    channel TEXT NOT NULL,
+    date TEXT NOT NULL,
+    due REAL NOT NULL,
+    backoff INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    PRIMARY KEY (channel, date)
+);
+"""
+
+
+def program_days(channel: Channel) -> dict[date, list[Program]]:
+    """
+    Group programs of channel by start date, sorted by start time.
+    """
+    return channel.programs.days()
+
+
+def hash_programs(programs: list[Program]) -> str:
+    """
+    Hash the content of programs, to find out changed channel-days.
+    """
+    sha = hashlib.sha1()
+    for program in programs:
+        sha.update(
+            repr(
+                (
+                    program.start_time.isoformat(),
+                    program.end_time.isoformat(),
+                    program.title,
+                    program.sub_title,
+                    program.desc,
+                    program.episode,
+                )
+            ).encode()
+        )
+    return sha.hexdigest()
+
+
+def _offset(dt: datetime) -> int:
+    return int(dt.utcoffset().total_seconds())
+
+
+def _datetime(timestamp: int, offset: int) -> datetime:
+    return datetime.fromtimestamp(timestamp, timezone(timedelta(seconds=offset)))
+
+
+class Store:
+    """
+    Program store.
+
+    Attributes:
+        path (str): The path of the SQLite database.
+
+    Methods:
+        is_empty() -> bool: Check if nothing is stored yet.
+        load(channels: list[Channel]) -> tuple[int, set]: Load programs in the recap/preview window of channels.
+        save(channels: list[Channel]) -> int: Write back changed channel-days.
+        load_schedule() -> Schedule: Load the refresh schedule.
+        save_schedule(schedule: Schedule) -> None: Write the refresh schedule.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # Kept open between builds of the scheduler, which runs them in its worker threads, one at a time
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.__db.close()
+
+    def is_empty(self) -> bool:
+        return self.__db.execute("SELECT 1 FROM channels LIMIT 1").fetchone() is None
+
+    def load(self, channels: list[Channel]) -> tuple[int, set]:
+        """
+        Load programs in the recap/preview window of channels.
+
+        Args:
+            channels (list[Channel]): The channels to load to.
+
+        Returns:
+            tuple[int, set]: The number of reused channels and the dates of the programs.
+        """
+        num_reuse_channels = 0
+        dates = set()
+        today = datetime.now().date()
+        for channel in channels:
+            row = self.__db.execute(
+                "SELECT last_update, last_scraper FROM channels WHERE id = ?",
+                (channel.id,),
+            ).fetchone()
+            if row is None:
+                continue
+            num_reuse_channels += 1
+            min_date = today - timedelta(channel.metadata.get("recap") or 0)
+            max_date = today + timedelta(channel.metadata.get("preview") or 0)
+            rows = self.__db.execute(
+                "SELECT start, start_offset, stop, stop_offset, title, sub_title, desc, episode, source"
+                " FROM programs WHERE channel = ? AND date BETWEEN ? AND ? ORDER BY start",
+                (channel.id, min_date.isoformat(), max_date.isoformat()),
+            )
+            for start, start_offset, stop, stop_offset, *fields in rows:
+                title, sub_title, desc, episode, source = fields
+                program = Program(
+                    title,
+                    _datetime(start, start_offset),
+                    _datetime(stop, stop_offset),
+                    source,
+                    desc,
+                    episode,
+                    sub_title,
+                )
+                dates.add(program.start_time.date())
+                channel.programs.append(program)
+            if channel.programs != []:
+                channel.metadata["last_update"] = datetime.fromisoformat(row[0])
+                channel.metadata["last_scraper"] = row[1]
+            else:
+                channel.metadata["last_update"] = datetime(
+                    1970, 1, 1, 0, 0, 0, tzinfo=tz_shanghai
+                )
+        return (num_reuse_channels, dates)
+
+    def save(self, channels: list[Channel]) -> int:
+        """
+        Write back the channel-days whose programs changed, and drop days out of the recap window.
+        Channels must have been loaded from this store first, or their missing days are dropped.
+
+        Args:
+            channels (list[Channel]): The channels to save.
+
+        Returns:
+            int: The number of channel-days written.
+        """
+        num_changed_days = 0
+        today = datetime.now().date()
+        with self.__db:
+            for channel in channels:
+                self.__db.execute(
+                    "INSERT OR REPLACE INTO channels (id, last_update, last_scraper) VALUES (?, ?, ?)",
+                    (
+                        channel.id,
+                        channel.metadata["last_update"].isoformat(),
+                        channel.metadata.get("last_scraper"),
+                    ),
+                )
+                stored_hashes = dict(
+                    self.__db.execute(
+                        "SELECT date, hash FROM channel_days WHERE channel = ?",
+                        (channel.id,),
+                    ).fetchall()
+                )
+                days = program_days(channel)
+                for day, programs in days.items():
+                    day_hash = hash_programs(programs)
+                    if stored_hashes.get(day.isoformat()) == day_hash:
+                        continue
+                    self.__write_day(channel.id, day, programs, day_hash)
+                    num_changed_days += 1
+                # Days flushed without new programs
+                for day in stored_hashes.keys() - {day.isoformat() for day in days}:
+                    for table in ("programs", "channel_days"):
+                        self.__db.execute(
+                            f"DELETE FROM {table} WHERE channel = ? AND date = ?",
+                            (channel.id, day),
+                        )
+                    num_changed_days += 1
+                min_date = today - timedelta(channel.metadata.get("recap") or 0)
+                for table in ("programs", "channel_days"):
+                    self.__db.execute(
+                        f"DELETE FROM {table} WHERE channel = ? AND date < ?",
+                        (channel.id, min_date.isoformat()),
+                    )
+        return num_changed_days
+
+    def load_schedule(self) -> Schedule:
+        rows = self.__db.execute(
+            "SELECT channel, date, due, backoff, kind FROM refresh_schedule"
+        )
+        return Schedule(
+            {
+                (channel_id, day): (due, backoff, kind)
+                for channel_id, day, due, backoff, kind in rows
+            }
+        )
+
+    def save_schedule(self, schedule: Schedule) -> None:
+        with self.__db:
+            self.__db.execute("DELETE FROM refresh_schedule")
+            self.__db.executemany(
+                "INSERT INTO refresh_schedule (channel, date, due, backoff, kind) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (channel_id, day, *entry)
+                    for (channel_id, day), entry in schedule.entries.items()
+                ],
+            )
+
+    def __write_day(
+        self, channel_id: str, day: date, programs: list[Program], day_hash: str
+    ) -> None:
+        self.__db.execute(
+            "DELETE FROM programs WHERE channel = ? AND date = ?",
+            (channel_id, day.isoformat()),
+        )
+        self.__db.executemany(
+            "INSERT INTO programs (channel, date, start, start_offset, stop, stop_offset, title, sub_title, desc, episode, source)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    channel_id,
+                    day.isoformat(),
+                    int(program.start_time.timestamp()),
+                    _offset(program.start_time),
+                    int(program.end_time.timestamp()),
+                    _offset(program.end_time),
+                    program.title,
+                    program.sub_title,
+                    program.desc,
+                    program.episode,
+                    program.channel,
+                )
+                for program in programs
+            ],
+        )
+        self.__db.execute(
+            "INSERT OR REPLACE INTO channel_days (channel, date, hash) VALUES (?, ?, ?)",
+            (channel_id, day.isoformat(), day_hash),
+        )
@@ -6,8 +6,14 @@ Maybe I should add a verbose option. Or use logging.
 """
 
 import yaml
-import importlib
-from epg.model import Channel
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from epg import profiler
+from epg import registry
+from epg.model import Channel, Program
+from epg.schedule import Schedule
+from epg.store import hash_programs
 from datetime import datetime, date, timedelta
 from epg.scraper import tz_shanghai
 
@@ -26,6 +32,7 @@ def load_config(path: str) -> list[Channel]:
     with open(path, "r") as stream:
         try:
             channels_config = yaml.safe_load(stream)
+            registry.load(channels_config)
             for channel_id in channels_config:
                 metadata = channels_config[channel_id]
                 metadata.update(
@@ -38,6 +45,9 @@ def load_config(path: str) -> list[Channel]:
                         lambda channel, date: scrap_channel(
                             channel, channels_config, date
                         ),
+                        lambda channel, start, end: scrap_channel_range(
+                            channel, channels_config, start, end
+                        ),
                     )
                 )
         except yaml.YAMLError as exc:
@@ -45,37 +55,99 @@ def load_config(path: str) -> list[Channel]:
     return channels
 
 
-def scrap_channel(
-    channel: Channel, channels_config, date: date = datetime.today().date()
-) -> bool:
+def scrap_channel(channel: Channel, channels_config, date: date | None = None) -> bool:
     """
-    Scrap channel with the given date.
+    Scrap channel with the given date. Scrapers not serving the date are not called.
 
     Args:
         channel (Channel): The channel to scrap.
         channels_config (dict): The channels config.
-        date (date, optional): The date to scrap. Defaults to datetime.today().date().
+        date (date, optional): The date to scrap. Defaults to today.
 
     Returns:
         bool: True if the channel is updated, False otherwise.
     """
+    today = datetime.today().date()
+    date = today if date is None else date
     channel.metadata["last_scraper"] = "FAILED"
-    for scraper in channels_config[channel.id]["scraper"]:
-        scraper_module = importlib.import_module("epg.scraper" + "." + scraper)
-        update = getattr(scraper_module, "update")
-        if update(channel, channels_config[channel.id]["scraper"][scraper], date):
-            channel.metadata["last_scraper"] = scraper
+    for scraper, scraper_id in registry.scrapers(channel):
+        if not scraper.supports(date, today):
+            continue
+        with profiler.measure("scrapers", scraper.name):
+            ok = scraper.update(channel, scraper_id, date)
+        if ok:
+            channel.metadata["last_scraper"] = scraper.name
             channel.metadata["last_update"] = datetime.now().astimezone()
-            if channel.metadata.get("plugin") != None:
-                plugin_module = importlib.import_module(
-                    "epg.plugin" + "." + channel.metadata["plugin"]
-                )
-                plugin_update = getattr(plugin_module, "update")
-                plugin_update(channel, date)
+            run_plugin(channel, date)
             return True
     return False
 
 
+def scrap_channel_range(
+    channel: Channel, channels_config, start: date, end: date
+) -> dict[date, str]:
+    """
+    Scrap channel for every date from start to end, both included.
+    Scrapers defining update_range() fetch the dates in one call, others are called day by day.
+    Scrapers are tried in order for the dates not updated yet, and in their date window.
+
+    Args:
+        channel (Channel): The channel to scrap.
+        channels_config (dict): The channels config.
+        start (date): The first date to scrap.
+        end (date): The last date to scrap.
+
+    Returns:
+        dict[date, str]: The updated dates and the scraper used for each of them.
+    """
+    channel.metadata["last_scraper"] = "FAILED"
+    today = datetime.today().date()
+    dates = [start + timedelta(i) for i in range((end - start).days + 1)]
+    updated = {}
+    for scraper, scraper_id in registry.scrapers(channel):
+        if len(updated) == len(dates):
+            break
+        remaining = [
+            dt for dt in dates if dt not in updated and scraper.supports(dt, today)
+        ]
+        if remaining == []:
+            continue
+        update_range = scraper.update_range
+        if update_range is not None:
+            # Only request contiguous dates, not to overwrite the dates of a previous scraper
+            done = []
+            run = [remaining[0]]
+            for dt in remaining[1:] + [None]:
+                if dt is not None and dt == run[-1] + timedelta(1):
+                    run.append(dt)
+                    continue
+                with profiler.measure("scrapers", scraper.name):
+                    done += update_range(channel, scraper_id, run[0], run[-1])
+                if dt is not None:
+                    run = [dt]
+        else:
+            done = []
+            for dt in remaining:
+                with profiler.measure("scrapers", scraper.name):
+                    if scraper.update(channel, scraper_id, dt):
+                        done.append(dt)
+        for dt in done:
+            updated[dt] = scraper.name
+            channel.metadata["last_scraper"] = scraper.name
+            channel.metadata["last_update"] = datetime.now().astimezone()
+            run_plugin(channel, dt)
+    return updated
+
+
+def run_plugin(channel: Channel, date: date) -> None:
+    """
+    Run the plugin of channel, if any, on the given date.
+    """
+    if channel.metadata.get("plugin") != None:
+        with profiler.measure("plugins", channel.metadata["plugin"]):
+            registry.plugin(channel.metadata["plugin"])(channel, date)
+
+
 def copy_channels(
     channels: list[Channel], new_channels: list[Channel]
 ) -> tuple[int, set]:
@@ -91,189 +163,376 @@ def copy_channels(
     """
     num_reuse_channels = 0
     dates = set()
+    today = datetime.now().date()
+    new_channels_by_id = {new_channel.id: new_channel for new_channel in new_channels}
     for channel in channels:
-        for new_channel in new_channels:
-            if channel.id == new_channel.id:
-                # Keep the programs in recap days
-                for program in new_channel.programs:
-                    recap_days = (
-                        channel.metadata.get("recap")
-                        if channel.metadata.get("recap") != None
-                        else 0
-                    )
-                    preview_days = (
-                        channel.metadata.get("preview")
-                        if channel.metadata.get("preview") != None
-                        else 0
-                    )
-                    if (
-                        datetime.now().date() + timedelta(preview_days)
-                        >= program.start_time.date()
-                        >= datetime.now().date() - timedelta(recap_days)
-                    ):
-                        dates.add(program.start_time.date())
-                        channel.programs.append(program)
-                num_reuse_channels += 1
-                channel.programs = list(set(channel.programs))  # Remove duplicates
-                # print("reuse channel:", channel.id, channel.metadata["name"], xml_channel.metadata["last_update"].astimezone().isoformat(), channel.metadata["refresh"])
-                if channel.programs != []:
-                    channel.metadata["last_update"] = new_channel.metadata[
-                        "last_update"
-                    ]
-                else:
-                    channel.metadata["last_update"] = datetime(
-                        1970, 1, 1, 0, 0, 0, tzinfo=tz_shanghai
-                    )
-                break
+        new_channel = new_channels_by_id.get(channel.id)
+        if new_channel is None:
+            continue
+        # Keep the programs in recap and preview days
+        min_date = today - timedelta(channel.metadata.get("recap") or 0)
+        max_date = today + timedelta(channel.metadata.get("preview") or 0)
+        reused_programs = [
+            program
+            for program in new_channel.programs
+            if min_date <= program.start_time.date() <= max_date
+        ]
+        dates.update(program.start_time.date() for program in reused_programs)
+        num_reuse_channels += 1
+        channel.programs = merge_programs(channel.programs, reused_programs)
+        if channel.programs != []:
+            channel.metadata["last_update"] = new_channel.metadata["last_update"]
+        else:
+            channel.metadata["last_update"] = datetime(
+                1970, 1, 1, 0, 0, 0, tzinfo=tz_shanghai
+            )
     return (num_reuse_channels, dates)
 
 
-def update_preview(channel: Channel) -> int:
+def merge_programs(
+    programs: list[Program], new_programs: list[Program]
+) -> list[Program]:
     """
-    Update channel preview.
+    Merge two program lists into one sorted list in one pass.
+    Duplicates are removed. If programs overlap, the ones from programs win over new_programs.
 
     Args:
-        channel (Channel): The channel to update.
+        programs (list[Program]): The programs to keep first.
+        new_programs (list[Program]): The programs to add.
 
     Returns:
-        int: The number of days previewed."""
-    previewed_days = 0
-    if channel.metadata.get("preview") == None:
-        return previewed_days
-    if channel.metadata["preview"] > 0:
-        max_date = datetime.now().date() + timedelta(channel.metadata["preview"])
-        pointer_date = datetime.now().date()
-        # for program in channel.programs:
-        #     if program.start_time.date() > channel_max_date:
-        #         channel_max_date = program.start_time.date()
-        if pointer_date < max_date:
-            print("preview <- ", end="", flush=True)
+        list[Program]: The merged programs, sorted by start time.
+    """
+    old_programs = sorted(programs, key=lambda x: x.start_time)
+    merged = []
+    # Old programs merged so far, the next one is old_programs[num_old]
+    num_old = 0
+    old_end = None
+    # sorted() is linear on already sorted lists
+    for program, priority in heapq.merge(
+        ((program, 0) for program in old_programs),
+        ((program, 1) for program in sorted(new_programs, key=lambda x: x.start_time)),
+        key=lambda x: (x[0].start_time, x[1]),
+    ):
+        if priority == 0:
+            num_old += 1
+        if merged != []:
+            last = merged[-1]
+            if program == last or program.start_time == last.start_time:
+                continue
+        if priority == 0:
+            if program.end_time is not None and (
+                old_end is None or program.end_time > old_end
+            ):
+                old_end = program.end_time
         else:
-            print("no need to refresh preview", flush=True)
-        while pointer_date < max_date:
-            pointer_date += timedelta(1)
-            if channel.update(pointer_date):
-                previewed_days += 1
-                if pointer_date < max_date:
-                    print(
-                        pointer_date,
-                        channel.metadata["last_scraper"],
-                        end=", ",
-                        flush=True,
-                    )
-                else:
-                    print(pointer_date, channel.metadata["last_scraper"], flush=True)
-    return previewed_days
+            # Drop a new program overlapping the previous or the next old program
+            if old_end is not None and program.start_time < old_end:
+                continue
+            if (
+                num_old < len(old_programs)
+                and program.end_time is not None
+                and old_programs[num_old].start_time < program.end_time
+            ):
+                continue
+        merged.append(program)
+    return merged
 
 
-def update_recap(channel: Channel) -> int:
+def trim_channel(channel: Channel, today: date) -> int:
     """
-    Update channel recap.
+    Drop programs of the days before the recap window of channel.
+    A channel kept in memory between builds would keep them forever otherwise.
 
     Args:
-        channel (Channel): The channel to update.
+        channel (Channel): The channel.
+        today (date): The date of today.
 
     Returns:
-        int: The number of days recaped."""
-    recaped_days = 0
-    if channel.metadata.get("recap") == None:
-        return recaped_days
-    if channel.metadata["recap"] > 0:
-        min_date = datetime.now().date() - timedelta(channel.metadata["recap"])
-        pointer_date = min_date
-        max_date = datetime.now().date()
-        for program in channel.programs:
-            if program.start_time.date() < max_date:
-                max_date = program.start_time.date()
-        if pointer_date < max_date:
-            print(
-                "recap",
-                min_date,
-                "->",
-                str(max_date - timedelta(1)) + ":",
-                end=" ",
-                flush=True,
-            )
+        int: The number of dropped days.
+    """
+    min_date = today - timedelta(channel.metadata.get("recap") or 0)
+    old_days = [day for day in channel.programs.days() if day < min_date]
+    for day in old_days:
+        channel.flush(day)
+    return len(old_days)
+
+
+def print_updated(updated: dict[date, str], dates: list[date], today: date) -> None:
+    """
+    Print the scraper used for each date, split into recap, today and preview.
+
+    Args:
+        updated (dict[date, str]): The updated dates and their scrapers.
+        dates (list[date]): The dates tried.
+        today (date): The date of today.
+    """
+    recap = [dt for dt in dates if dt < today]
+    preview = [dt for dt in dates if dt > today]
+    if recap != []:
+        print(
+            "recap",
+            recap[0],
+            "->",
+            str(recap[-1]) + ":",
+            ", ".join(f"{dt} {updated.get(dt, 'FAILED')}" for dt in recap),
+            flush=True,
+        )
+    if today in dates:
+        print("today <-", updated.get(today, "FAILED"), flush=True)
+    if preview != []:
+        print(
+            "preview <-",
+            ", ".join(f"{dt} {updated.get(dt, 'FAILED')}" for dt in preview),
+            flush=True,
+        )
+
+
+def hash_channel_days(channels: list[Channel]) -> dict[str, str]:
+    """
+    Hash the programs of every channel-day, keyed by "<channel id>/<date>", in channel order.
+    """
+    return {
+        f"{channel.id}/{day.isoformat()}": hash_programs(programs)
+        for channel in channels
+        for day, programs in channel.programs.days().items()
+    }
+
+
+def print_changes(old: dict[str, str], new: dict[str, str]) -> int:
+    """
+    Print the channel-days changed since the last build, one channel per line.
+
+    Args:
+        old (dict[str, str]): The channel-day hashes of the last build.
+        new (dict[str, str]): The channel-day hashes of this build.
+
+    Returns:
+        int: The number of changed channel-days.
+    """
+    changed = {}
+    for key in new.keys() | old.keys():
+        if new.get(key) != old.get(key):
+            channel_id, day = key.rsplit("/", 1)
+            mark = "+" if key not in old else "-" if key not in new else "~"
+            changed.setdefault(channel_id, []).append(mark + day)
+    for channel_id in sorted(changed):
+        print(
+            "changed",
+            channel_id + ":",
+            ", ".join(sorted(changed[channel_id], key=lambda x: x[1:])),
+            flush=True,
+        )
+    return sum(len(days) for days in changed.values())
+
+
+def contiguous_ranges(dates: list[date]) -> list[tuple[date, date]]:
+    """
+    Split sorted dates into (start, end) ranges of consecutive days.
+    """
+    ranges = []
+    for dt in dates:
+        if ranges != [] and ranges[-1][1] + timedelta(1) == dt:
+            ranges[-1] = (ranges[-1][0], dt)
         else:
-            print("no need to refresh recap", flush=True)
-        while pointer_date < max_date:
-            if channel.update(pointer_date):
-                recaped_days += 1
-                if recaped_days < channel.metadata.get("recap"):
-                    print(
-                        pointer_date,
-                        channel.metadata["last_scraper"],
-                        end=", ",
-                        flush=True,
-                    )
-                else:
-                    print(pointer_date, channel.metadata["last_scraper"], flush=True)
-            pointer_date += timedelta(1)
-    return recaped_days
+            ranges.append((dt, dt))
+    return ranges
 
 
-def update_channel_full(channel, num_refresh_channels):
+def update_channel_dates(
+    channel: Channel, dates: list[date], num_refresh_channels: int
+) -> dict[date, str]:
     """
-    Update channel full.
+    Update channel on the given dates.
+    Consecutive dates are scraped as one date range.
 
     Args:
         channel (Channel): The channel to update.
+        dates (list[date]): The sorted dates to update.
         num_refresh_channels (int): Counter of the number of channels that have been refreshed.
+
+    Returns:
+        dict[date, str]: The updated dates and their scrapers.
     """
+    today = datetime.now().date()
+    print(
+        num_refresh_channels + 1,
+        channel.id,
+        channel.metadata["name"],
+        "last update:",
+        channel.metadata["last_update"],
+        flush=True,
+    )
+    updated = {}
+    for start, end in contiguous_ranges(dates):
+        updated.update(channel.update_range(start, end))
+    print_updated(updated, dates, today)
+    return updated
 
-    def _update_recap(channel):
-        recaped_days = update_recap(channel)
-        if recaped_days > 0:
-            print("total:", recaped_days, flush=True)
-            return True
-        return False
 
-    def _update_preview(channel):
-        previewed_days = update_preview(channel)
-        if previewed_days > 0:
-            print("total:", previewed_days, flush=True)
-            return True
-        return False
+def supports_range(channel: Channel) -> bool:
+    """
+    Check if the first scraper of channel fetches several days in one call.
+    """
+    for scraper, _ in registry.scrapers(channel):
+        return scraper.update_range is not None
+    return False
 
-    if channel.metadata["refresh"] == "today":
-        print(
-            num_refresh_channels + 1,
-            channel.id,
-            channel.metadata["name"],
-            "last update:",
+
+def _job_cost(channel: Channel, start: date, end: date) -> float:
+    """
+    Estimate the cost of scraping channel from start to end with its first scraper.
+    """
+    for scraper, _ in registry.scrapers(channel):
+        if scraper.update_range is not None:
+            return scraper.cost
+        return scraper.cost * ((end - start).days + 1)
+    return 0
+
+
+def _scrap_channel_range(
+    channel: Channel, start: date, end: date
+) -> tuple[Channel, dict[date, str]]:
+    """
+    Scrap channel from start to end into a fork of the channel. Runs in a worker thread.
+    """
+    fork = channel.fork()
+    return (fork, fork.update_range(start, end))
+
+
+def update_channels(
+    channels: list[Channel], workers: int = 1, schedule: Schedule | None = None
+) -> int:
+    """
+    Update the due channel-days of all channels, then schedule them again.
+    Channel-days no scraper of the channel serves today are not dispatched: they are deferred
+    to the day they enter a scraper window, or backed off if they never will.
+    With more than one worker, channels are scraped concurrently into forks,
+    one job per channel-day, or one per range of consecutive days if its scraper supports date ranges.
+    The forks are merged back by the calling thread only.
+
+    Args:
+        channels (list[Channel]): The channels to update.
+        workers (int, optional): The number of worker threads. Defaults to 1.
+        schedule (Schedule, optional): The refresh schedule. Without it, the whole window of every channel is due.
+
+    Returns:
+        int: The number of refreshed channels.
+    """
+    today = datetime.now().date()
+    schedule = Schedule() if schedule is None else schedule
+    schedule.sync(channels, today, time.time())
+    due = schedule.pop_due(time.time())
+    plans = {}
+    num_skipped = 0
+    for channel in channels:
+        if channel.id not in due:
+            continue
+        dates = []
+        for dt in due[channel.id]:
+            first_day = registry.opens(channel, dt, today)
+            if first_day == today:
+                dates.append(dt)
+                continue
+            num_skipped += 1
+            if first_day is None:
+                schedule.done(channel, dt, today, time.time(), False, False)
+            else:
+                schedule.defer(
+                    channel,
+                    dt,
+                    today,
+                    datetime.combine(first_day, datetime.min.time()).timestamp(),
+                )
+        if dates == []:
+            continue
+        days = channel.programs.days()
+        # Hashes before refreshing, to back off from channel-days that don't change
+        hashes = {dt: hash_programs(days.get(dt, [])) for dt in dates}
+        plans[channel.id] = (
+            dates,
             channel.metadata["last_update"],
+            {},
+            set(),
+            hashes,
         )
-        _update_recap(channel)
+
+    def reschedule(channel: Channel) -> None:
+        dates, _, updated, _, hashes = plans[channel.id]
+        days = channel.programs.days()
+        for dt in dates:
+            changed = hash_programs(days.get(dt, [])) != hashes[dt]
+            schedule.done(channel, dt, today, time.time(), dt in updated, changed)
+
+    if num_skipped > 0:
         print(
-            channel.metadata["refresh"],
-            "<- now",
-            datetime.now().astimezone().isoformat(),
-            end=" ",
+            "number of channel-days out of scraper windows, not dispatched:",
+            num_skipped,
             flush=True,
         )
-        if channel.update():
-            print(channel.metadata["last_scraper"], flush=True)
-        _update_preview(channel)
-        return True
-    if channel.metadata["refresh"] == "once":
-        if channel.metadata["last_update"].date() != datetime.now().date():
+    num_refresh_channels = 0
+    if workers <= 1:
+        for channel in channels:
+            if channel.id not in plans:
+                continue
+            dates, _, updated, _, _ = plans[channel.id]
+            try:
+                updated.update(
+                    update_channel_dates(channel, dates, num_refresh_channels)
+                )
+            except Exception as exc:
+                print("Fail:", channel.id, dates[0], "->", dates[-1], exc, flush=True)
+                channel.metadata["last_scraper"] = "FAILED"
+            finally:
+                # Popped from the schedule, it must be pushed back even if it failed
+                num_refresh_channels += 1
+                reschedule(channel)
+        return num_refresh_channels
+
+    jobs = []
+    for channel in channels:
+        if channel.id not in plans:
+            continue
+        dates = plans[channel.id][0]
+        if supports_range(channel):
+            jobs += [(channel, start, end) for start, end in contiguous_ranges(dates)]
+        else:
+            jobs += [(channel, dt, dt) for dt in dates]
+    # Costly jobs first, so they don't start last and hold the build
+    jobs.sort(key=lambda job: _job_cost(*job), reverse=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_scrap_channel_range, channel, start, end): (
+                channel,
+                start,
+                end,
+            )
+            for channel, start, end in jobs
+        }
+        for future in as_completed(futures):
+            channel, start, end = futures[future]
+            dates, last_update, updated, done, _ = plans[channel.id]
+            try:
+                fork, fork_updated = future.result()
+                if fork_updated:
+                    channel.merge(fork, list(fork_updated))
+                    updated.update(fork_updated)
+            except Exception as exc:
+                print("Fail:", channel.id, start, "->", end, exc, flush=True)
+            done.update(dt for dt in dates if start <= dt <= end)
+            if len(done) < len(dates):
+                continue
+            # All days of this channel are done
+            num_refresh_channels += 1
+            if updated == {}:
+                channel.metadata["last_scraper"] = "FAILED"
             print(
-                num_refresh_channels + 1,
+                num_refresh_channels,
                 channel.id,
                 channel.metadata["name"],
                 "last update:",
-                channel.metadata["last_update"],
-            )
-            _update_recap(channel)
-            print(
-                channel.metadata["refresh"],
-                "<-",
-                datetime.now().isoformat(),
-                end=" ",
-                flush=True,
+                last_update,
             )
-            channel.update()
-            print(channel.metadata["last_scraper"], flush=True)
-            _update_preview(channel)
-            return True
-    return False
+            print_updated(updated, dates, today)
+            reschedule(channel)
+    return num_refresh_channels
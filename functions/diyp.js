@@ -24,7 +24,23 @@ export async function onRequest(context) {
     },
   };
 
-  const response = await fetch(url);
+  // Same as normalize_name() in epg/generator/diyp.py
+  function normalizeName(name) {
+    return name.normalize('NFKC').toLowerCase().replace(/[\s\-_]+/g, '');
+  }
+
+  var response = await fetch(url);
+  if (response.status != 200) {
+    // Another name of the channel, resolve it through the alias index
+    const aliases = await fetch(`${protocol}//${host}${pathname}_files/aliases.json`);
+    if (aliases.status == 200) {
+      const index = await aliases.json();
+      const name = index[channel_name] || index[normalizeName(channel_name)];
+      if (name) {
+        response = await fetch(encodeURI(`${protocol}//${host}${pathname}_files/${name}/${date_str}.json`));
+      }
+    }
+  }
   var result = await gatherResponse(response);
   if (response.status != 200) {
     const resJson = {
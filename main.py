@@ -1,11 +1,20 @@
 from jinja2 import Environment, FileSystemLoader, select_autoescape
+from epg import profiler
 from epg import utils
+from epg.model import Channel
+from epg.store import Store
+from epg.schedule import Schedule
 from epg.generator import xmltv
 from epg.generator import diyp
-from epg.scraper import __xmltv
+from epg.generator import guide
+from epg.scraper import __xmltv as xmltv_parser
+from epg.scraper import xmltv as xmltv_scraper
 from lxml import etree
 from datetime import datetime, timezone
 from croniter import croniter
+import gzip
+import hashlib
+import json
 import os
 import shutil
 
@@ -14,132 +23,339 @@ CF_PAGES_URL = os.getenv("CF_PAGES_URL")
 DEPLOY_HOOK = os.getenv("DEPLOY_HOOK")
 CLOUDFLARE_API_TOKEN = os.getenv("CLOUDFLARE_API_TOKEN")
 XMLTV_URL = os.getenv("XMLTV_URL", "")
+XMLTV_GZIP = os.getenv("XMLTV_GZIP", "1") == "1"
+# full: validate every element, sample: one in every 100 programmes, off: no validation
+XMLTV_VALIDATE = os.getenv("XMLTV_VALIDATE", "full")
+STORE_PATH = os.getenv("STORE_PATH", os.path.join(os.getcwd(), "config", "epg.db"))
+# Hashes of the last build, to skip unchanged stages. Not in web/, which is served as is
+BUILD_STATE_PATH = os.getenv(
+    "BUILD_STATE_PATH", os.path.join(os.getcwd(), "config", "build_state.json")
+)
+REFRESH_WORKERS = int(os.getenv("REFRESH_WORKERS", "1"))
 TZ = os.getenv("TZ")
-if TZ is None:
-    print(
-        "!!!Please set TZ environment variables to define timezone or it will use system timezone by default!!!"
-    )
 CRON_TRIGGER = os.getenv("CRON_TRIGGER", "0 0 * * *")
-next_cron_time = (
-    croniter(CRON_TRIGGER, datetime.now(timezone.utc))
-    .get_next(datetime)
-    .replace(tzinfo=timezone.utc)
-    .astimezone()
-)
+# Comma separated: "time" records times by stage, scraper, plugin and host,
+# "cprofile" adds cProfile, "memory" adds the peak memory. Empty is off.
+PROFILE = os.getenv("PROFILE", "")
+# Profiles hold source paths, keep them out of web/
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.getcwd(), "config", "profile"))
+
+
+class Builder:
+    """
+    EPG builder. The DTD, the parsed config with the programs of channels, the store
+    and the templates are kept between builds, so a long running process builds without reloading them.
+
+    Attributes:
+        channels (list[Channel]): The channels of the config.
+        store (Store | None): The program store.
+        schedule (Schedule): The refresh schedule of channel-days.
+
+    Methods:
+        load() -> None: Load the config and reuse programs from the store or XMLTV_URL.
+        build() -> int: Refresh channels and write all outputs.
+        close() -> None: Close the store.
+    """
+
+    def __init__(self) -> None:
+        if TZ is None:
+            print(
+                "!!!Please set TZ environment variables to define timezone or it will use system timezone by default!!!"
+            )
+        self.dtd = etree.DTD(open("xmltv.dtd", "r"))
+        self.config_path = os.path.join(os.getcwd(), "config", "channels.yaml")
+        self.web_path = os.path.join(os.getcwd(), "web")
+        self.epg_path = os.path.join(self.web_path, "epg.xml")
+        if not os.path.exists(self.web_path):
+            os.mkdir(self.web_path)
+        self.store = Store(STORE_PATH) if STORE_PATH != "" else None
+        self.channels: list[Channel] = []
+        self.schedule = Schedule()
+        self.__config_mtime = None
+        # Load the template
+        templateLoader = FileSystemLoader(
+            searchpath=os.path.join(os.getcwd(), "templates")
+        )
+        env = Environment(
+            loader=templateLoader,
+            autoescape=select_autoescape(["html", "xml", "jinja2"]),
+        )
+        self.template = env.get_template("index.html.jinja2")
 
-dtd = etree.DTD(open("xmltv.dtd", "r"))
-
-now = datetime.now()
-current_timezone = now.astimezone().tzinfo
-timezone_name = current_timezone.tzname(now) if current_timezone else "UTC"
-timezone_offset = now.astimezone().strftime("%z")
-print("use timezone:", timezone_name, f"UTC{timezone_offset}", flush=True)
-
-config_path = os.path.join(os.getcwd(), "config", "channels.yaml")
-epg_path = os.path.join(os.getcwd(), "web", "epg.xml")
-if not os.path.exists(os.path.join(os.getcwd(), "web")):
-    os.mkdir(os.path.join(os.getcwd(), "web"))
-
-channels = utils.load_config(config_path)
-
-if XMLTV_URL == "":
-    xml_channels = []
-    print("!!!Please set XMLTV_URL environment variables to reuse XML!!!")
-else:
-    print("reuse XML:", XMLTV_URL, flush=True)
-    xml_channels = __xmltv.get_channels(XMLTV_URL, dtd)
-    # Reuse channels
-    if xml_channels != []:
-        xml_result = utils.copy_channels(channels, xml_channels)
-        num_reuse_channels = xml_result[0]
-        xml_dates = xml_result[1]
-        if xml_dates:
-            min_xml_date = min(xml_dates)
-            max_xml_date = max(xml_dates)
+    def load(self) -> None:
+        """
+        Load the config, then reuse programs from the store, or from XMLTV_URL if the store is empty.
+        """
+        self.__config_mtime = os.stat(self.config_path).st_mtime_ns
+        with profiler.stage("config"):
+            channels = utils.load_config(self.config_path)
+        self.channels = channels
+        store = self.store
+        dtd = self.dtd
+
+        if store is not None and not store.is_empty():
+            print("reuse store:", STORE_PATH, flush=True)
+            with profiler.stage("reuse store"):
+                num_reuse_channels, store_dates = store.load(channels)
+                self.schedule = store.load_schedule()
+            print(
+                f"number of reused channels: {num_reuse_channels}/{len(channels)}"
+                f" from {min(store_dates, default=None)} to {max(store_dates, default=None)}",
+                flush=True,
+            )
+        elif XMLTV_URL == "":
+            xml_channels = []
+            print("!!!Please set XMLTV_URL environment variables to reuse XML!!!")
         else:
-            print("xml_dates is empty")
-            min_xml_date = None
-            max_xml_date = None
+            print("reuse XML:", XMLTV_URL, flush=True)
+            with profiler.stage("reuse xml"):
+                xml_channels = xmltv_parser.get_channels(
+                    XMLTV_URL, dtd, {channel.id for channel in channels}
+                )
+            # Reuse channels
+            if xml_channels != []:
+                xml_result = utils.copy_channels(channels, xml_channels)
+                num_reuse_channels = xml_result[0]
+                xml_dates = xml_result[1]
+                if xml_dates:
+                    min_xml_date = min(xml_dates)
+                    max_xml_date = max(xml_dates)
+                else:
+                    print("xml_dates is empty")
+                    min_xml_date = None
+                    max_xml_date = None
+                print(
+                    f"number of reused channels: {num_reuse_channels}/{len(channels)} from {min_xml_date} to {max_xml_date}",
+                    flush=True,
+                )
+
+    def build(self) -> int:
+        """
+        Refresh channels and write all outputs. The config is loaded again only if it changed.
+        With PROFILE set, the profile of the build is written to PROFILE_DIR.
+
+        Returns:
+            int: The number of refreshed channels.
+        """
+        profiler.start(PROFILE)
+        try:
+            return self.__build()
+        finally:
+            report = profiler.stop(PROFILE_DIR)
+            if report is not None:
+                profiler.print_report(report)
+
+    def __build(self) -> int:
+        now = datetime.now()
+        current_timezone = now.astimezone().tzinfo
+        timezone_name = current_timezone.tzname(now) if current_timezone else "UTC"
+        timezone_offset = now.astimezone().strftime("%z")
+        print("use timezone:", timezone_name, f"UTC{timezone_offset}", flush=True)
+
+        if os.stat(self.config_path).st_mtime_ns != self.__config_mtime:
+            self.load()
+        channels = self.channels
+        # XMLTV sources are downloaded again on every build
+        xmltv_scraper.clear()
+        for channel in channels:
+            utils.trim_channel(channel, now.date())
+
+        print("refreshing with", REFRESH_WORKERS, "workers...", flush=True)
+
+        with profiler.stage("refresh"):
+            num_refresh_channels = utils.update_channels(
+                channels, REFRESH_WORKERS, self.schedule
+            )
+
         print(
-            f"number of reused channels: {num_reuse_channels}/{len(channels)} from {min_xml_date} to {max_xml_date}",
+            f"number of refreshed channels: {num_refresh_channels}/{len(channels)}",
             flush=True,
         )
 
-print("refreshing...")
+        if self.store is not None:
+            with profiler.stage("store save"):
+                print(
+                    "number of stored channel-days:",
+                    self.store.save(channels),
+                    flush=True,
+                )
+                self.store.save_schedule(self.schedule)
 
-num_refresh_channels = 0
-for channel in channels:
-    if utils.update_channel_full(channel, num_refresh_channels):
-        num_refresh_channels += 1
+        self.publish(num_refresh_channels)
+        return num_refresh_channels
 
-print(
-    f"number of refreshed channels: {num_refresh_channels}/{len(channels)}", flush=True
-)
+    def publish(self, num_refresh_channels: int) -> None:
+        """
+        Write epg.xml, DIYP files, the guide index and the home page, then deploy.
+        A stage is skipped if its inputs are the same as in the last build and its output exists.
+        """
+        channels = self.channels
+        epg_path = self.epg_path
+        state_path = BUILD_STATE_PATH
+        # Written in web/ by previous versions
+        legacy_state_path = os.path.join(self.web_path, ".build_state.json")
+        if os.path.exists(legacy_state_path):
+            os.remove(legacy_state_path)
+        try:
+            with open(state_path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {"days": {}, "stages": {}}
+        with profiler.stage("change detection"):
+            day_hashes = utils.hash_channel_days(channels)
+            num_changed_days = utils.print_changes(state["days"], day_hashes)
+        print("number of changed channel-days:", num_changed_days, flush=True)
+        guide_key = [
+            [channel.id, channel.metadata["name"]] for channel in channels
+        ] + list(day_hashes.items())
+        # Convert CRON_TRIGGER next cron time to datetime type
+        next_update_time = (
+            croniter(CRON_TRIGGER, datetime.now(timezone.utc))
+            .get_next(datetime)
+            .replace(tzinfo=timezone.utc)
+            .astimezone()
+        )
+        timezone_offset = datetime.now().astimezone().strftime("%z")
+        last_update_date = max(
+            channel.metadata["last_update"] for channel in channels
+        ).date()
+        stages = {
+            # The date attribute of epg.xml is the date of the last update
+            "xmltv": [guide_key, last_update_date.isoformat(), XMLTV_GZIP],
+            "diyp": [guide_key, CF_PAGES is None],
+            "guide": guide_key,
+            # The next update time changes on every tick, the page may show a past one
+            # until the guide changes again
+            "html": [guide_key, CRON_TRIGGER, timezone_offset],
+            "deploy": [guide_key, CRON_TRIGGER, DEPLOY_HOOK],
+        }
+        stages = {
+            name: hashlib.sha1(json.dumps(key).encode()).hexdigest()
+            for name, key in stages.items()
+        }
+        outputs = {
+            "xmltv": [epg_path] + ([epg_path + ".gz"] if XMLTV_GZIP else []),
+            "diyp": [os.path.join(self.web_path, "diyp_files")],
+            "guide": [os.path.join(self.web_path, "guide.json")],
+            "html": [os.path.join(self.web_path, "index.html")],
+            "deploy": [],
+        }
+        skipped = [
+            name
+            for name in stages
+            if state["stages"].get(name) == stages[name]
+            and all(os.path.exists(path) for path in outputs[name])
+        ]
+        if skipped != []:
+            print("unchanged, skip:", ", ".join(skipped), flush=True)
 
-print("deploying...", flush=True)
-print("file path:", epg_path, flush=True)
-xmltv.write(epg_path, channels, "epghub")
+        print("deploying...", flush=True)
+        print("file path:", epg_path, flush=True)
+        if "xmltv" not in skipped:
+            with profiler.stage("xmltv"):
+                valid = xmltv.write(
+                    epg_path,
+                    channels,
+                    "epghub",
+                    epg_path + ".gz" if XMLTV_GZIP else "",
+                    self.dtd,
+                    {"full": 1, "sample": 100, "off": 0}.get(XMLTV_VALIDATE, 1),
+                )
+            if not valid:
+                print("!!!epg.xml is not valid!!!", flush=True)
+                # Write it again next time
+                stages["xmltv"] = None
 
-xml = open(epg_path, "rb")
-root = etree.XML(xml.read())
-valid = dtd.validate(root)
-if not valid:
-    print(dtd.error_log.filter_from_errors()[0])
+        # Cloudflare Pages uploads files, not symlinks, so update them in place there.
+        # It also compresses by itself, so no .gz siblings.
+        if "diyp" not in skipped:
+            with profiler.stage("diyp"):
+                diyp.write(
+                    os.path.join(self.web_path, "diyp_files"),
+                    channels,
+                    atomic=CF_PAGES is None,
+                    gzip=CF_PAGES is None,
+                )
 
-diyp.write(os.path.join(os.getcwd(), "web", "diyp_files"), channels)
+        # The guide index of the API
+        if "guide" not in skipped:
+            with profiler.stage("guide"):
+                guide.write(os.path.join(self.web_path, "guide.json"), channels)
 
-# Load the template
-templateLoader = FileSystemLoader(searchpath=os.path.join(os.getcwd(), "templates"))
-env = Environment(
-    loader=templateLoader,
-    autoescape=select_autoescape(["html", "xml", "jinja2"]),
-)
-template = env.get_template("index.html.jinja2")
-
-title = "EPG"
-channel_list = [channel.metadata["name"][0] for channel in channels]
-first_channel = channel_list[0]
-channel_list = channel_list[1:]
-# Convert CRON_TRIGGER next cron time to datetime type
-next_update_time = next_cron_time
-
-# Render the template with the list
-rendered_html = template.render(
-    title=title,
-    channel_list=channel_list,
-    first_channel=first_channel,
-    num_refresh_channels=num_refresh_channels,
-    num_channels=len(channels),
-    last_update_time=datetime.now().astimezone().isoformat(timespec="seconds"),
-    next_update_time=next_update_time,
-    update_trigger=CRON_TRIGGER,
-    timezone_offset=timezone_offset,
-)
+        if "html" not in skipped:
+            title = "EPG"
+            channel_list = [channel.metadata["name"][0] for channel in channels]
+            first_channel = channel_list[0]
+            channel_list = channel_list[1:]
 
-open(os.path.join(os.getcwd(), "web", "index.html"), "w").write(rendered_html)
-shutil.copyfile(
-    os.path.join(os.getcwd(), "templates", "404.html"),
-    os.path.join(os.getcwd(), "web", "404.html"),
-)
-shutil.copyfile(
-    os.path.join(os.getcwd(), "templates", "404.json"),
-    os.path.join(os.getcwd(), "web", "404.json"),
-)
-shutil.copyfile(
-    os.path.join(os.getcwd(), "templates", "robots.txt"),
-    os.path.join(os.getcwd(), "web", "robots.txt"),
-)
+            # Render the template with the list
+            with profiler.stage("html"):
+                rendered_html = self.template.render(
+                    title=title,
+                    channel_list=channel_list,
+                    first_channel=first_channel,
+                    num_refresh_channels=num_refresh_channels,
+                    num_channels=len(channels),
+                    last_update_time=datetime.now()
+                    .astimezone()
+                    .isoformat(timespec="seconds"),
+                    next_update_time=next_update_time,
+                    update_trigger=CRON_TRIGGER,
+                    timezone_offset=timezone_offset,
+                )
 
-if CF_PAGES is not None:
-    if CLOUDFLARE_API_TOKEN is None:
-        print(
-            "!!!Please set DEPLOY_HOOK environment variables to deploy automatically!!!"
+                html_path = os.path.join(self.web_path, "index.html")
+                with open(html_path + ".tmp", "w") as f:
+                    f.write(rendered_html)
+                os.replace(html_path + ".tmp", html_path)
+                # No .gz sibling for Cloudflare Pages, as for DIYP files
+                if CF_PAGES is None:
+                    with open(html_path + ".gz.tmp", "wb") as f:
+                        # mtime=0 to get the same bytes for the same content
+                        f.write(gzip.compress(rendered_html.encode(), mtime=0))
+                    os.replace(html_path + ".gz.tmp", html_path + ".gz")
+        shutil.copyfile(
+            os.path.join(os.getcwd(), "templates", "404.html"),
+            os.path.join(self.web_path, "404.html"),
         )
-    if DEPLOY_HOOK is None:
-        print(
-            "!!!Please set CLOUDFLARE_API_TOKEN environment variables to deploy automatically!!!"
+        shutil.copyfile(
+            os.path.join(os.getcwd(), "templates", "404.json"),
+            os.path.join(self.web_path, "404.json"),
         )
-    if DEPLOY_HOOK is not None and CLOUDFLARE_API_TOKEN is not None:
-        cmd = f'cd workers && npx --yes wrangler deploy --var DEPLOY_HOOK:{DEPLOY_HOOK} --triggers "{CRON_TRIGGER}"'
-        # print(cmd)
-        os.system(cmd)
+        shutil.copyfile(
+            os.path.join(os.getcwd(), "templates", "robots.txt"),
+            os.path.join(self.web_path, "robots.txt"),
+        )
+
+        if CF_PAGES is not None and "deploy" not in skipped:
+            if CLOUDFLARE_API_TOKEN is None:
+                print(
+                    "!!!Please set DEPLOY_HOOK environment variables to deploy automatically!!!"
+                )
+            if DEPLOY_HOOK is None:
+                print(
+                    "!!!Please set CLOUDFLARE_API_TOKEN environment variables to deploy automatically!!!"
+                )
+            if DEPLOY_HOOK is not None and CLOUDFLARE_API_TOKEN is not None:
+                cmd = f'cd workers && npx --yes wrangler deploy --var DEPLOY_HOOK:{DEPLOY_HOOK} --triggers "{CRON_TRIGGER}"'
+                # print(cmd)
+                with profiler.stage("deploy"):
+                    os.system(cmd)
+
+        with open(state_path + ".tmp", "w") as f:
+            json.dump({"days": day_hashes, "stages": stages}, f)
+        os.replace(state_path + ".tmp", state_path)
+
+    def close(self) -> None:
+        if self.store is not None:
+            self.store.close()
+
+
+def main() -> None:
+    builder = Builder()
+    builder.build()
+    builder.close()
+
+
+if __name__ == "__main__":
+    main()
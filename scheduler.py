@@ -1,15 +1,24 @@
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
 import time
+import traceback
 from datetime import timezone
 import os
+from main import Builder
 
 CRON_TRIGGER = os.getenv("CRON_TRIGGER", "0 0 * * *")
 
+# Builds run in this process, the config, programs, store and HTTP pools stay warm between them
+builder = Builder()
+
 
 def my_task():
     print("CRON task：", time.strftime("%Y-%m-%d %H:%M:%S"))
-    os.system("poetry run python main.py")
+    try:
+        builder.build()
+    except Exception:
+        # Keep the scheduler running, the next tick builds again
+        traceback.print_exc()
 
 
 # 创建一个调度器
@@ -19,11 +28,14 @@ scheduler = BlockingScheduler()
 cron_trigger = CronTrigger.from_crontab(CRON_TRIGGER, timezone.utc)
 
 # 添加任务和触发器
-scheduler.add_job(my_task, cron_trigger)
+scheduler.add_job(my_task, cron_trigger, max_instances=1, coalesce=True)
 
 # 启动调度器
 print("Start api server...")
 PORT = os.getenv("PORT", "6688")
-os.system("poetry run python main.py")
+my_task()
 print(f"Start scheduler with cron trigger: {CRON_TRIGGER}", flush=True)
-scheduler.start()
\ No newline at end of file
+try:
+    scheduler.start()
+finally:
+    builder.close()